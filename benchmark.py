@@ -0,0 +1,285 @@
+"""
+Benchmark of the CobayaCAMB_mnuEff theory in its positive, massless and negative
+mnu_eff branches.
+
+The model is built from the theory and parameter blocks in defaults/, with a synthetic
+likelihood requesting the products used by the CMB and BAO likelihoods, so only a local
+CAMB installation is needed. Every (settings, branch) combination runs in a fresh
+process, so that the peak memory is that of the combination alone. For example
+
+    python benchmark.py --lmax 2500 4000 --threads 4 8 --output bench.json
+    python benchmark.py --option parallel_transfers=true --compare bench.json
+"""
+
+import argparse
+import datetime
+import functools
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+DEFAULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'defaults')
+THEORY_NAME = 'disputauble.CobayaCAMB_mnuEff'
+BRANCHES = {'positive': 0.1, 'massless': 0.0, 'negative': -0.1}
+# redshifts of the DESI DR2 BAO measurements
+BAO_Z = [0.295, 0.51, 0.706, 0.934, 1.321, 1.484, 2.33]
+# largest multipole used by the CMB (CamSpec, ACT/Planck lensing) likelihoods
+CMB_LMAX = 2500
+
+
+def load_defaults(*names):
+    from cobaya.yaml import yaml_load_file
+    info = {}
+    for name in names:
+        info.update(yaml_load_file(os.path.join(DEFAULTS, name + '.yaml')))
+    return info
+
+
+def reference_point(params):
+    """
+    Centre of the reference distribution (or of the prior) of the sampled parameters.
+    """
+    point = {}
+    for p, info in params.items():
+        if not isinstance(info, dict) or 'prior' not in info:
+            continue
+        ref = info.get('ref')
+        if isinstance(ref, dict):
+            point[p] = ref['loc']
+        elif ref is not None:
+            point[p] = ref
+        elif 'loc' in info['prior']:
+            point[p] = info['prior']['loc']
+        else:
+            point[p] = (info['prior']['min'] + info['prior']['max']) / 2
+    return point
+
+
+def benchmark_likelihood(_self=None):
+    """
+    Synthetic likelihood that only accesses the theory products (so that those computed
+    on demand are included in the timings).
+    """
+    _self.provider.get_Cl(ell_factor=True)
+    _self.provider.get_angular_diameter_distance(BAO_Z)
+    _self.provider.get_Hubble(BAO_Z)
+    _self.provider.get_param('rdrag')
+    return 0.0
+
+
+def unknown_extra_args(extra_args):
+    """
+    Get the extra_args not recognised by the local CAMB version (e.g. options of newer
+    versions pinned in defaults/).
+    """
+    import camb
+    unknown = []
+    for name, value in extra_args.items():
+        try:
+            camb.set_params(**{name: value})
+        except camb.baseconfig.CAMBUnknownArgumentError:
+            unknown.append(name)
+        except Exception:
+            pass
+    return unknown
+
+
+def build_model(settings):
+    from cobaya.model import get_model
+    theory = load_defaults(settings['theory'])
+    theory_info = theory[THEORY_NAME]
+    theory_info['extra_args'].update(settings['extra_args'])
+    for name in settings['dropped_extra_args']:
+        theory_info['extra_args'].pop(name, None)
+    theory_info.update(settings['options'])
+    params = load_defaults('lcdm', 'mnu_eff', 'tau=0.06')
+    lmax = min(theory_info['extra_args']['lmax'], CMB_LMAX)
+    likelihood = {'benchmark': {'external': benchmark_likelihood,
+                                'requires': {'Cl': {cl: lmax for cl in ('tt', 'te', 'ee', 'pp')},
+                                             'angular_diameter_distance': {'z': BAO_Z},
+                                             'Hubble': {'z': BAO_Z}, 'rdrag': None}}}
+    return get_model({'theory': theory, 'likelihood': likelihood, 'params': params}), params
+
+
+class _Counted:
+    """
+    Wrapper counting and timing the calls to a function
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.calls = 0
+        self.times = []
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        start = time.perf_counter()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.times.append(time.perf_counter() - start)
+
+    def __get__(self, instance, owner=None):
+        # also count calls of methods when set as class attribute
+        return self if instance is None else functools.partial(self, instance)
+
+
+def peak_rss_mb():
+    import resource
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_branch(settings, branch, repeats):
+    """
+    Time the evaluations of the model at `repeats` points of the given branch (run in
+    the process of a single benchmark).
+    """
+    model, params = build_model(settings)
+    theory = model.theory[THEORY_NAME]
+    transfers = theory._camb_transfers
+    rss_init = peak_rss_mb()
+
+    timed = {'theory': _Counted(theory.calculate), 'transfers': _Counted(transfers.calculate)}
+    theory.calculate = timed['theory']
+    transfers.calculate = timed['transfers']
+    camb = theory.camb
+    counted = {name: _Counted(getattr(camb, name)) for name in ('get_transfer_functions', 'get_background')}
+    for name, function in counted.items():
+        setattr(camb, name, function)
+    counted['power_spectra_from_transfer'] = _Counted(camb.CAMBdata.power_spectra_from_transfer)
+    camb.CAMBdata.power_spectra_from_transfer = counted['power_spectra_from_transfer']
+
+    point = reference_point(params)
+    point['mnu_eff'] = BRANCHES[branch]
+    total = []
+    for i in range(repeats):
+        # move a slow parameter, so that every evaluation solves CAMB from scratch
+        point['omch2'] = params['omch2']['ref']['loc'] * (1 + 1e-3 * i)
+        start = time.perf_counter()
+        result = model.logposterior(point)
+        total.append(time.perf_counter() - start)
+        if not np.isfinite(result.logpost):
+            raise RuntimeError(f"Evaluation failed at {point}")
+    model.close()
+    return {'branch': branch, 'mnu_eff': BRANCHES[branch],
+            'logposterior_s': total,
+            'theory_calculate_s': timed['theory'].times,
+            'transfers_calculate_s': timed['transfers'].times,
+            'camb_calls_per_point': {name: c.calls / repeats for name, c in counted.items()},
+            'massless_cache': dict(transfers.massless_cache_stats),
+            'rss_after_init_mb': rss_init,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run_isolated(settings, branch, repeats):
+    """
+    Run a benchmark in a new process with the requested number of OpenMP threads.
+    """
+    previous = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(settings['threads'])
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            return executor.submit(run_branch, settings, branch, repeats).result()
+    finally:
+        if previous is None:
+            del os.environ['OMP_NUM_THREADS']
+        else:
+            os.environ['OMP_NUM_THREADS'] = previous
+
+
+def metadata():
+    import camb
+    import cobaya
+    import disputauble
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(), 'host': platform.node(), 'python': platform.python_version(),
+            'camb': camb.__version__, 'cobaya': cobaya.__version__, 'disputauble': disputauble.__version__,
+            'git_commit': commit, 'cpus': os.cpu_count()}
+
+
+def run_key(run):
+    # theory options are left out, to compare e.g. runs with and without parallel_transfers
+    settings = {k: v for k, v in run['settings'].items() if k != 'options'}
+    return json.dumps([settings, run['branch']], sort_keys=True)
+
+
+def compare(runs, reference_file):
+    """
+    Print the change of the median evaluation time with respect to a previous benchmark.
+    """
+    with open(reference_file) as f:
+        reference = {run_key(run): run for run in json.load(f)['runs']}
+    print(f"\nMedian logposterior time relative to {reference_file}:")
+    for run in runs:
+        old = reference.get(run_key(run))
+        if old is None:
+            print(f"  {run_key(run)}: not in reference")
+            continue
+        ratio = np.median(run['logposterior_s']) / np.median(old['logposterior_s'])
+        print(f"  {run_key(run)}: x{ratio:.3f}")
+
+
+def parse_option(text):
+    import yaml
+    name, _, value = text.partition('=')
+    return name, yaml.safe_load(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--theory', default='camb_mnu-eff_nuDegenerate',
+                        help='theory block in defaults/ (default: %(default)s)')
+    parser.add_argument('--branches', nargs='+', choices=list(BRANCHES), default=list(BRANCHES))
+    parser.add_argument('--lmax', nargs='+', type=int, default=[4000])
+    parser.add_argument('--threads', nargs='+', type=int,
+                        default=[int(os.environ.get('OMP_NUM_THREADS') or os.cpu_count() or 1)])
+    parser.add_argument('--accuracy-boost', nargs='+', type=float, default=[1.0])
+    parser.add_argument('--lens-potential-accuracy', nargs='+', type=int, default=[4])
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help='theory option, e.g. parallel_transfers=true (can be repeated)')
+    parser.add_argument('--repeats', type=int, default=3, help='points evaluated per benchmark')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file with the results')
+    parser.add_argument('--compare', metavar='JSON', help='previous results to compare with')
+    args = parser.parse_args(argv)
+
+    options = dict(parse_option(option) for option in args.option)
+    runs = []
+    for lmax, threads, boost, lens_accuracy in itertools.product(args.lmax, args.threads, args.accuracy_boost,
+                                                                  args.lens_potential_accuracy):
+        extra_args = {'lmax': lmax, 'AccuracyBoost': boost, 'lens_potential_accuracy': lens_accuracy}
+        dropped = unknown_extra_args({**load_defaults(args.theory)[THEORY_NAME]['extra_args'], **extra_args})
+        if dropped:
+            print(f"Ignoring extra_args not recognised by the local CAMB: {dropped}")
+        settings = {'theory': args.theory, 'threads': threads, 'options': options, 'extra_args': extra_args,
+                    'dropped_extra_args': dropped}
+        for branch in args.branches:
+            result = run_isolated(settings, branch, args.repeats)
+            runs.append({'settings': settings, **result})
+            print(f"lmax={lmax} threads={threads} AccuracyBoost={boost} lens_potential_accuracy={lens_accuracy} "
+                  f"{branch:>8}: {np.median(result['logposterior_s']):7.2f} s/point, "
+                  f"{result['camb_calls_per_point']['get_transfer_functions']:.1f} transfer solves/point, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB", flush=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': metadata(), 'runs': runs}, f, indent=1)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Column-oriented binary copies of Cobaya chains, loaded without parsing text.
+
+Each ``chains/<name>.<i>.txt`` set is converted once into ``chains/<name>.npchains/``,
+with one ``.npy`` file per column (all chains concatenated) and a ``meta.json`` sidecar
+with the chain boundaries, parameter labels and ranges, R-1 and the text files it was
+made from. The loader memory-maps the columns and only reads those requested, e.g.
+
+    python binary_chains.py chains/
+    python binary_chains.py chains/lcdm_mnu=free_tau=free_cmb-p+cmb-l+bao --force
+
+The copy is only used while the text chains are unchanged, so a resumed chain falls
+back to the text files until it is converted again.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+from chain_store import chain_files, file_stamp
+
+FORMAT_VERSION = 1
+SUFFIX = '.npchains'
+# burn-in fractions for which R-1 is computed at conversion
+IGNORE_ROWS = (0.3,)
+
+
+def binary_dir(root):
+    return root + SUFFIX
+
+
+def meta_file(root):
+    return os.path.join(binary_dir(root), 'meta.json')
+
+
+def column_file(root, column):
+    return os.path.join(binary_dir(root), column + '.npy')
+
+
+def read_meta(root):
+    """
+    Read the metadata of the binary copy of the chains, or None if there is none.
+    """
+    try:
+        with open(meta_file(root), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('format') == FORMAT_VERSION else None
+
+
+def _sources(root):
+    # as stored in JSON, to compare with the metadata
+    return json.loads(json.dumps(file_stamp(chain_files(root))))
+
+
+def is_current(root, meta=None):
+    """
+    Whether the binary copy exists and was made from the current text chains.
+    """
+    meta = meta or read_meta(root)
+    return meta is not None and meta['sources'] == _sources(root)
+
+
+def convert(root, ignore_rows=IGNORE_ROWS):
+    """
+    Write the binary copy of the chains with the given root (e.g. ``chains/<name>``).
+
+    Returns
+    -------
+    dict
+        The metadata written.
+    """
+    from getdist.mcsamples import loadMCSamples
+    sources = _sources(root)
+    if not sources:
+        raise FileNotFoundError(f"No chain files for {root}")
+    samples = loadMCSamples(root, settings={'ignore_rows': 0})
+    names = samples.getParamNames().names
+    os.makedirs(binary_dir(root), exist_ok=True)
+    columns = {'weight': samples.weights, 'minuslogpost': samples.loglikes}
+    columns.update({p.name: samples.samples[:, i] for i, p in enumerate(names)})
+    for column, values in columns.items():
+        np.save(column_file(root, column), np.ascontiguousarray(values))
+    meta = {'format': FORMAT_VERSION, 'sources': sources,
+            'chain_offsets': [int(i) for i in samples.chain_offsets],
+            'params': [{'name': p.name, 'label': p.label, 'derived': bool(p.isDerived)} for p in names],
+            'ranges': {p.name: [samples.ranges.getLower(p.name), samples.ranges.getUpper(p.name)] for p in names},
+            'sampler': samples.sampler, 'label': samples.label, 'gelman_rubin': {}}
+    _write_meta(root, meta)
+    for fraction in ignore_rows:
+        samples = load_samples(root, ignore_rows=fraction, meta=meta)
+        meta['gelman_rubin'][str(fraction)] = float(samples.getGelmanRubin())
+    _write_meta(root, meta)
+    return meta
+
+
+def _write_meta(root, meta):
+    filename = meta_file(root)
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def load_samples(root, params=None, ignore_rows=0.3, meta=None):
+    """
+    Build getdist MCSamples from the binary copy of the chains, reading only the
+    columns of the given parameters (all by default).
+    """
+    from getdist.mcsamples import MCSamples
+    meta = meta or read_meta(root)
+    if meta is None:
+        raise FileNotFoundError(f"No binary chains for {root}, convert them with binary_chains.py")
+    info = {p['name']: p for p in meta['params']}
+    params = list(info) if params is None else list(params)
+    unknown = [p for p in params if p not in info]
+    if unknown:
+        raise ValueError(f"Parameters {unknown} not in the chains {root}")
+    offsets = meta['chain_offsets']
+
+    def chains(column):
+        values = np.load(column_file(root, column), mmap_mode='r')
+        return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    columns = [chains(p) for p in params]
+    samples = [np.column_stack([column[i] for column in columns]) for i in range(len(offsets) - 1)]
+    return MCSamples(samples=samples, weights=[np.array(w) for w in chains('weight')],
+                     loglikes=[np.array(lp) for lp in chains('minuslogpost')],
+                     names=[p + '*' if info[p]['derived'] else p for p in params],
+                     labels=[info[p]['label'] for p in params],
+                     ranges={p: meta['ranges'][p] for p in params}, sampler=meta['sampler'],
+                     label=meta['label'], name_tag=os.path.basename(root),
+                     settings={'ignore_rows': ignore_rows})
+
+
+def gelman_rubin(root, ignore_rows=0.3, meta=None):
+    """
+    Get the R-1 computed at conversion for the given burn-in fraction, or None.
+    """
+    meta = meta or read_meta(root)
+    return None if meta is None else meta['gelman_rubin'].get(str(ignore_rows))
+
+
+def find_roots(chain_dir):
+    """
+    Get the roots of all chains in a directory.
+    """
+    pattern = re.compile(r'(.*?)(\.\d+)?\.txt$')
+    roots = set()
+    for filename in glob.glob(os.path.join(glob.escape(chain_dir), '*.txt')):
+        root = pattern.match(filename).group(1)
+        if filename in chain_files(root) and not root.endswith('.minimum'):
+            roots.add(root)
+    return sorted(roots)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert text chains into memory-mappable binary columns")
+    parser.add_argument('paths', nargs='+', help='chain roots (e.g. chains/<name>) or directories of chains')
+    parser.add_argument('--force', action='store_true', help='convert even if the binary copy is current')
+    parser.add_argument('--ignore-rows', nargs='+', type=float, default=list(IGNORE_ROWS),
+                        help='burn-in fractions for which R-1 is stored (default: %(default)s)')
+    args = parser.parse_args(argv)
+    roots = []
+    for path in args.paths:
+        roots += find_roots(path) if os.path.isdir(path) else [path]
+    for root in roots:
+        if not args.force and is_current(root):
+            print(f"Up to date: {root}")
+            continue
+        meta = convert(root, args.ignore_rows)
+        print(f"Converted {root}: {meta['chain_offsets'][-1]} samples in {len(meta['chain_offsets']) - 1} chains, "
+              f"{len(meta['params'])} parameters", flush=True)
+
+
+if __name__ == '__main__':
+    main()
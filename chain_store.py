@@ -0,0 +1,139 @@
+"""
+In-process store of the chain outputs used by do_analysis.py: getdist samples, R-1,
+best fits and minimizer inputs. Each item is read the first time it is requested and
+then kept, keyed on the paths and modification times of the files it was read from,
+so every file is parsed once per run unless it changes (e.g. a chain is resumed).
+Chains with a current binary copy (see binary_chains.py) are loaded from it.
+"""
+
+import glob
+import os
+import re
+from collections import Counter
+
+import numpy as np
+import yaml
+
+
+def file_stamp(paths):
+    """
+    Identify the current version of a set of files by their paths, sizes and
+    modification times (None for missing files).
+    """
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamp.append((path, None))
+        else:
+            stamp.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(stamp)
+
+
+def chain_files(root):
+    """
+    Get the chain files of a Cobaya output root: ``<root>.txt`` or one ``<root>.<i>.txt``
+    per MPI rank.
+    """
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'(\.\d+)?\.txt$')
+    return sorted(f for f in glob.glob(glob.escape(root) + '*.txt') if pattern.match(os.path.basename(f)))
+
+
+def read_best_fit(filename):
+    """
+    Read a Cobaya .minimum.txt file as a dictionary of parameter values.
+    """
+    with open(filename, encoding='utf-8') as f:
+        header = [line for line in f if line.startswith('#')][-1]
+    return dict(zip(header[1:].split(), np.atleast_1d(np.loadtxt(filename))))
+
+
+class ChainStore:
+    """
+    Memoized access to the outputs in a chains directory.
+
+    Parameters
+    ----------
+    chain_dir : str
+        Directory with the Cobaya outputs.
+    ignore_rows : float
+        Burn-in fraction removed from each chain.
+    """
+
+    def __init__(self, chain_dir='chains', ignore_rows=0.3):
+        self.chain_dir = chain_dir
+        self.ignore_rows = ignore_rows
+        self._memo = {}
+        self.stats = Counter()
+
+    def root(self, name):
+        return os.path.join(self.chain_dir, name)
+
+    def _get(self, kind, name, paths, load):
+        stamp = file_stamp(paths)
+        cached = self._memo.get((kind, name))
+        if cached is not None and cached[0] == stamp:
+            self.stats[kind + '.hits'] += 1
+            return cached[1]
+        self.stats[kind + '.loads'] += 1
+        value = load()
+        # an older version is replaced, so that changed files do not accumulate
+        self._memo[(kind, name)] = (stamp, value)
+        return value
+
+    def samples(self, name, params=None):
+        """
+        Get the getdist MCSamples of the chains with the given name, after burn-in
+        removal. The same object is returned to all callers, so it should not be modified.
+
+        If the chains have a current binary copy, only the given parameters (all by
+        default) are loaded; text chains are always loaded in full.
+        """
+        import binary_chains
+        from getdist.mcsamples import loadMCSamples
+        root = self.root(name)
+        meta = binary_chains.read_meta(root)
+        if binary_chains.is_current(root, meta):
+            key = name if params is None else (name, tuple(params))
+            return self._get('samples', key, chain_files(root) + [binary_chains.meta_file(root)],
+                             lambda: binary_chains.load_samples(root, params, self.ignore_rows, meta))
+        return self._get('samples', name, chain_files(root),
+                         lambda: loadMCSamples(root, settings={'ignore_rows': self.ignore_rows}))
+
+    def gelman_rubin(self, name):
+        """
+        Get the R-1 of the chains with the given name (as computed at conversion for
+        chains with a current binary copy).
+        """
+        import binary_chains
+        root = self.root(name)
+        meta = binary_chains.read_meta(root)
+        if binary_chains.is_current(root, meta):
+            Rminus1 = binary_chains.gelman_rubin(root, self.ignore_rows, meta)
+            if Rminus1 is not None:
+                return Rminus1
+        return self._get('gelman_rubin', name, chain_files(root),
+                         lambda: self.samples(name).getGelmanRubin())
+
+    def best_fit(self, name):
+        """
+        Get the best-fit parameter values in ``<name>.minimum.txt``.
+        """
+        filename = self.root(name) + '.minimum.txt'
+        return self._get('best_fit', name, [filename], lambda: read_best_fit(filename))
+
+    def minimize_input(self, name):
+        """
+        Get the input of the minimizer run, from ``<name>.minimize.input.yaml``.
+        """
+        filename = self.root(name) + '.minimize.input.yaml'
+
+        def load():
+            with open(filename, encoding='utf-8') as f:
+                return yaml.load(f, Loader=yaml.SafeLoader)
+
+        return self._get('minimize_input', name, [filename], load)
+
+    def clear(self):
+        self._memo.clear()
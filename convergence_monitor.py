@@ -0,0 +1,290 @@
+"""
+Gelman-Rubin R-1 of running chains, updated from the rows appended since the last check.
+
+For each chain file the monitor keeps the read offset and running weighted sums of the
+sampled parameters (and their products) at block boundaries, so that R-1 after removing
+the burn-in fraction is updated in a time proportional to the new samples. The state is
+saved next to the chains (``<root>.monitor.pkl``), so repeated invocations only read
+what was appended since the previous one. E.g.
+
+    python convergence_monitor.py yamls/*.yaml
+    python convergence_monitor.py --check lcdm_mnu=free_tau=free_cmb-p+cmb-l+bao && echo converged
+    python convergence_monitor.py --watch 600 yamls/lcdm_mnu*.yaml
+
+R-1 is defined as in getdist's getGelmanRubin (as used by do_analysis.py), up to the
+burn-in boundary being rounded down to a block of rows.
+"""
+
+import argparse
+import bisect
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import yaml
+
+from chain_store import chain_files
+
+STATE_VERSION = 1
+# R-1 required for the chains to be used (RM1_CUT in do_analysis.py)
+RMINUS1 = 0.02
+# burn-in fraction removed from each chain (ignore_rows in do_analysis.py)
+BURN_IN = 0.3
+
+
+class ChainTail:
+    """
+    Running weighted sums of the given columns of a growing chain file, stored at
+    every `block_rows` rows.
+    """
+
+    def __init__(self, filename, columns, block_rows=100):
+        self.filename = filename
+        self.columns = list(columns)
+        self.block_rows = block_rows
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.inode = None
+        self.indices = None
+        self.shift = None
+        self.rows = 0
+        dim = len(self.columns)
+        self.sums = [0.0, np.zeros(dim), np.zeros((dim, dim))]
+        # sums of the rows before each block boundary
+        self.boundaries = [0]
+        self.block_sums = [[0.0, np.zeros(dim), np.zeros((dim, dim))]]
+
+    def update(self):
+        """
+        Read the rows appended since the last update.
+
+        Returns
+        -------
+        int
+            Number of new rows.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return 0
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # new or rewritten file
+            self.reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return 0
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # an incomplete last line is left for the next update
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        lines = data[:end].decode().splitlines()
+        if self.indices is None:
+            header = [line for line in lines if line.startswith('#')]
+            if not header:
+                return 0
+            names = header[0][1:].split()
+            self.indices = [names.index('weight')] + [names.index(p) for p in self.columns]
+        rows = [line.split() for line in lines if line.strip() and not line.startswith('#')]
+        if not rows:
+            return 0
+        values = np.array(rows, dtype=float)[:, self.indices]
+        if self.shift is None:
+            # sums relative to the first sample, for accuracy
+            self.shift = values[0, 1:].copy()
+        self.add(values[:, 0], values[:, 1:] - self.shift)
+        return len(values)
+
+    def add(self, weights, x):
+        start = 0
+        while start < len(weights):
+            # up to the next block boundary
+            stop = start + self.block_rows - self.rows % self.block_rows
+            w, y = weights[start:stop], x[start:stop]
+            self.sums[0] += w.sum()
+            self.sums[1] += w @ y
+            self.sums[2] += (y * w[:, None]).T @ y
+            self.rows += len(w)
+            if self.rows % self.block_rows == 0:
+                self.boundaries.append(self.rows)
+                self.block_sums.append([self.sums[0], self.sums[1].copy(), self.sums[2].copy()])
+            start = stop
+
+    def mean_and_cov(self, burn_in=BURN_IN):
+        """
+        Weighted mean and covariance of the rows after the burn-in (None if none).
+        """
+        i = bisect.bisect_right(self.boundaries, int(round(self.rows * burn_in))) - 1
+        W, S1, S2 = (total - before for total, before in zip(self.sums, self.block_sums[i]))
+        if self.rows == self.boundaries[i] or W <= 0:
+            return None
+        mean = S1 / W
+        return mean + self.shift, S2 / W - np.outer(mean, mean), W
+
+
+def gelman_rubin(stats):
+    """
+    Get R-1 from the (mean, covariance, total weight) of each chain: the largest
+    eigenvalue of the covariance of the chain means in the basis where the mean of the
+    chain covariances is the identity.
+    """
+    if len(stats) < 2:
+        return None
+    means = np.array([mean for mean, _, _ in stats])
+    weights = np.array([W for _, _, W in stats])
+    overall = weights @ means / weights.sum()
+    meanscov = sum(np.outer(m - overall, m - overall) for m in means) / (len(stats) - 1)
+    meancov = sum(cov for _, cov, _ in stats) / len(stats)
+    w, U = np.linalg.eigh(meancov)
+    if np.min(w) <= 0:
+        return None
+    U = U / np.sqrt(w)
+    return float(np.max(np.linalg.eigvalsh(U.T @ meanscov @ U)))
+
+
+def sampled_params(root):
+    """
+    Get the sampled parameters of a run from its ``.updated.yaml`` (None if not written yet).
+    """
+    try:
+        with open(root + '.updated.yaml', encoding='utf-8') as f:
+            info = yaml.safe_load(f)
+    except OSError:
+        return None
+    return [p for p, v in info['params'].items() if isinstance(v, dict) and 'prior' in v]
+
+
+class ConvergenceMonitor:
+    """
+    Convergence of the chains of one run, with the state kept between checks.
+
+    Parameters
+    ----------
+    root : str
+        Output root of the run, e.g. ``chains/<name>``.
+    burn_in : float
+        Fraction of the rows of each chain removed as burn-in.
+    block_rows : int
+        Rows between the stored partial sums (the resolution of the burn-in boundary).
+    """
+
+    def __init__(self, root, burn_in=BURN_IN, block_rows=100):
+        self.root = root
+        self.burn_in = burn_in
+        self.block_rows = block_rows
+        self.params = None
+        self.tails = {}
+
+    @classmethod
+    def load(cls, root, burn_in=BURN_IN, block_rows=100):
+        """
+        Get the monitor saved for the run, or a new one.
+        """
+        monitor = cls(root, burn_in, block_rows)
+        try:
+            with open(root + '.monitor.pkl', 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return monitor
+        if state.get('version') != STATE_VERSION or (state['burn_in'], state['block_rows']) != (burn_in, block_rows):
+            return monitor
+        monitor.params = state['params']
+        for filename, tail_state in state['tails'].items():
+            tail = monitor.tails[filename] = ChainTail(filename, monitor.params, block_rows)
+            tail.__dict__.update(tail_state)
+        return monitor
+
+    def save(self):
+        # plain data only, so that the state does not depend on how this module was imported
+        state = {'version': STATE_VERSION, 'burn_in': self.burn_in, 'block_rows': self.block_rows,
+                 'params': self.params, 'tails': {filename: vars(tail) for filename, tail in self.tails.items()}}
+        filename = self.root + '.monitor.pkl'
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(filename + '.tmp', filename)
+
+    def update(self):
+        """
+        Read the new rows of all chains and get the current status.
+
+        Returns
+        -------
+        dict
+            'chains' and 'rows' read, 'new_rows' since the last update, and 'Rminus1'
+            (None until there are two chains with samples after the burn-in).
+        """
+        if self.params is None:
+            self.params = sampled_params(self.root)
+            if self.params is None:
+                return {'chains': 0, 'rows': 0, 'new_rows': 0, 'Rminus1': None}
+        new_rows = 0
+        for filename in chain_files(self.root):
+            if filename not in self.tails:
+                self.tails[filename] = ChainTail(filename, self.params, self.block_rows)
+            new_rows += self.tails[filename].update()
+        stats = [s for s in (tail.mean_and_cov(self.burn_in) for tail in self.tails.values()) if s is not None]
+        return {'chains': len(self.tails), 'rows': sum(tail.rows for tail in self.tails.values()),
+                'new_rows': new_rows, 'Rminus1': gelman_rubin(stats)}
+
+
+def run_name(path):
+    return os.path.basename(path)[:-len('.yaml')] if path.endswith('.yaml') else os.path.basename(path)
+
+
+def check(names, chain_dir='chains', Rminus1=RMINUS1, burn_in=BURN_IN, save=True):
+    """
+    Update the monitors of the given runs.
+
+    Returns
+    -------
+    dict
+        Status of each run: as returned by ConvergenceMonitor.update, with 'converged'.
+    """
+    status = {}
+    for name in names:
+        monitor = ConvergenceMonitor.load(os.path.join(chain_dir, name), burn_in)
+        status[name] = monitor.update()
+        status[name]['converged'] = status[name]['Rminus1'] is not None and status[name]['Rminus1'] <= Rminus1
+        if save and monitor.tails:
+            monitor.save()
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gelman-Rubin R-1 of running chains")
+    parser.add_argument('runs', nargs='+', help='input yamls or run names')
+    parser.add_argument('--chains-dir', default='chains', help='directory of the chains (default: %(default)s)')
+    parser.add_argument('--rminus1', type=float, default=RMINUS1, help='R-1 for convergence (default: %(default)s)')
+    parser.add_argument('--burn-in', type=float, default=BURN_IN, help='burn-in fraction (default: %(default)s)')
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help='check again every SECONDS until all converge')
+    parser.add_argument('--json', help='also write the status to this file')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 unless all runs have converged')
+    args = parser.parse_args(argv)
+
+    names = [run_name(path) for path in args.runs]
+    while True:
+        status = check(names, args.chains_dir, args.rminus1, args.burn_in)
+        for name, s in status.items():
+            Rminus1 = 'n/a' if s['Rminus1'] is None else f"{s['Rminus1']:.4f}"
+            state = 'converged' if s['converged'] else ('not started' if not s['chains'] else 'running')
+            print(f"{name:<55} {state:<12} R-1={Rminus1:<8} {s['chains']} chains, {s['rows']} rows "
+                  f"(+{s['new_rows']})", flush=True)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(status, f, indent=1)
+        converged = all(s['converged'] for s in status.values())
+        if not args.watch or converged:
+            break
+        time.sleep(args.watch)
+    if args.check and not converged:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Staged CAMB accuracy: cheaper settings early in a run, stepping up to the configured ones."""
+
+import os
+from collections import deque
+
+import numpy as np
+
+# Conditions on which a stage hands over to the next one (any of them is enough)
+_triggers = ('Rminus1', 'evaluations', 'minimize_tol')
+
+
+def read_Rminus1(progress_file):
+    """
+    Get the last R-1 written by the Cobaya MCMC sampler to its .progress file, or None
+    if the file does not exist or has no finite R-1 yet.
+    """
+    try:
+        with open(progress_file, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    if not lines or not lines[0].startswith('#'):
+        return None
+    columns = lines[0][1:].split()
+    for line in reversed(lines[1:]):
+        values = line.split()
+        if len(values) != len(columns):
+            continue
+        try:
+            Rminus1 = float(values[columns.index('Rminus1')])
+        except ValueError:
+            return None
+        return Rminus1 if np.isfinite(Rminus1) else None
+    return None
+
+
+class AccuracyLadder:
+    """
+    Sequence of cheaper CAMB settings used before the production ones. Each stage is a
+    dictionary with the `extra_args` overriding the production settings, and one or
+    more triggers for stepping up to the next stage:
+
+    - ``Rminus1``: the last R-1 of the MCMC sampler (read from `progress_file`) is at
+      or below this value;
+    - ``evaluations``: this many parameter points have been computed in the stage;
+    - ``minimize_tol``: the best log-likelihood found so far improved by less than this
+      relative tolerance over the last ``minimize_window`` (default 50) points, in the
+      same sense as the ``tol`` of the Powell minimizer.
+
+    Stages are numbered from ``-len(stages)`` (the first, cheapest one) up to 0, the
+    production settings.
+    """
+
+    def __init__(self, stages, progress_file=None):
+        self.stages = [dict(stage) for stage in stages]
+        for stage in self.stages:
+            unknown = set(stage) - {'extra_args', 'minimize_window', *_triggers}
+            if unknown:
+                raise ValueError(f"unknown stage options {sorted(unknown)}")
+            if not any(trigger in stage for trigger in _triggers):
+                raise ValueError(f"stage {stage!r} has no trigger, one of {list(_triggers)} is needed")
+            if 'Rminus1' in stage and not progress_file:
+                raise ValueError("an Rminus1 trigger needs the progress_file of the sampler")
+        self.progress_file = progress_file
+        self.stage = -len(self.stages)
+        self.evaluations = 0
+        self._best_loglikes = None
+        self._progress_mtime = None
+        self._Rminus1 = None
+        self._start_stage()
+
+    def _start_stage(self):
+        self.evaluations = 0
+        window = self.stages[self.stage].get('minimize_window', 50) if self.stage < 0 else 0
+        # best log-likelihood so far, at the last window + 1 points
+        self._best_loglikes = deque(maxlen=window + 1)
+
+    def extra_args(self, production_extra_args):
+        """
+        Get the CAMB extra_args of the current stage.
+        """
+        extra_args = dict(production_extra_args)
+        if self.stage < 0:
+            extra_args.update(self.stages[self.stage].get('extra_args') or {})
+        return extra_args
+
+    def step(self, loglike=None):
+        """
+        Register a new parameter point, stepping up to the next stages while their
+        triggers are met.
+
+        Parameters
+        ----------
+        loglike : float, optional
+            Log-likelihood of the previous point, used by the ``minimize_tol`` trigger.
+
+        Returns
+        -------
+        bool
+            Whether the stage changed.
+        """
+        if self.stage >= 0:
+            return False
+        if loglike is not None and np.isfinite(loglike):
+            best = self._best_loglikes[-1] if self._best_loglikes else -np.inf
+            self._best_loglikes.append(max(loglike, best))
+        changed = False
+        while self.stage < 0 and self.triggered(self.stages[self.stage]):
+            self.stage += 1
+            self._start_stage()
+            changed = True
+        self.evaluations += 1
+        return changed
+
+    def triggered(self, stage):
+        """
+        Whether any of the triggers of the given (current) stage is met.
+        """
+        if 'evaluations' in stage and self.evaluations >= stage['evaluations']:
+            return True
+        best = self._best_loglikes
+        if 'minimize_tol' in stage and len(best) == best.maxlen:
+            if 2 * (best[-1] - best[0]) <= stage['minimize_tol'] * (abs(best[0]) + abs(best[-1])):
+                return True
+        if 'Rminus1' in stage:
+            Rminus1 = self.sampler_Rminus1()
+            if Rminus1 is not None and Rminus1 <= stage['Rminus1']:
+                return True
+        return False
+
+    def sampler_Rminus1(self):
+        """
+        Get the last R-1 of the sampler, only re-reading the progress file if it changed.
+        """
+        try:
+            mtime = os.stat(self.progress_file).st_mtime
+        except OSError:
+            return None
+        if mtime != self._progress_mtime:
+            self._progress_mtime = mtime
+            self._Rminus1 = read_Rminus1(self.progress_file)
+        return self._Rminus1
@@ -1,43 +1,272 @@
+from collections import OrderedDict
+from copy import deepcopy
+from functools import partial
+from typing import Optional
+
 import numpy as np
 
 from cobaya import LoggedError
 from cobaya.theories.camb import CAMB as CAMBBase
-from cobaya.theories.camb.camb import CambTransfers as CambTransfersBase
+from cobaya.theories.camb.camb import CAMBOutputs, CambTransfers as CambTransfersBase
+
+from .accuracy import AccuracyLadder
+from .disk_cache import ResultsDiskCache, hash_key
+from .instrumentation import RunStats, resident_memory_mb
+from .lincomb import LinearCombiner, relative_second_difference
+from .parallel import CambWorker, RemoteResults, camb_threads
 
 
-def difference_dicts(dict1, dict2):
+def _freeze(value):
     """
-    Compare two dictionaries and return the difference
+    Convert a (possibly nested) parameter or settings value into a hashable key
     """
+    if isinstance(value, dict):
+        return tuple(sorted(((k, _freeze(v)) for k, v in value.items()), key=lambda item: repr(item[0])))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        # iteration order depends on the hash seed of the process
+        return ('set',) + tuple(sorted((_freeze(v) for v in value), key=repr))
+    if isinstance(value, np.ndarray):
+        return value.dtype.str, value.shape, value.tobytes()
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _sort_lists(value):
+    """
+    Sort the lists and sets in (possibly nested) collector arguments. Cobaya builds some
+    of them from sets (e.g. the spectra of the Cl collector), so that their order depends
+    on the hash seed of the process while the products do not.
+    """
+    if isinstance(value, dict):
+        return {k: _sort_lists(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return tuple(_sort_lists(v) for v in value)
+    if isinstance(value, (list, set, frozenset)):
+        return sorted((_sort_lists(v) for v in value), key=repr)
+    return value
+
 
-    assert dict1.keys() == dict2.keys(), "Keys of the dictionaries do not match"
-    diff = {}
-    for k in dict1.keys():
-        if isinstance(dict1[k], (np.ndarray, int, float, complex)) and isinstance(dict2[k], (np.ndarray, int, float, complex)):
-            diff[k] = dict1[k] - dict2[k]
-        elif isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
-            diff[k] = difference_dicts(dict1[k], dict2[k])
+class _PendingProducts:
+    """
+    Products of a negative mnu_eff state that have not been computed yet, together with
+    what is needed to compute them on request.
+    """
 
-    return diff
+    def __init__(self, results, params_values_dict, products):
+        self.results = results
+        self.params_values_dict = params_values_dict
+        self.products = products
 
 
-def multiply_dict_by_factor(dict1, factor):
+class _ResolvingState:
     """
-    Multiply all values in a dictionary by a factor
+    View of a theory state that computes pending products the first time they are accessed
     """
-    out_dict = dict1.copy()
-    for k in dict1.keys():
-        if isinstance(dict1[k], (np.ndarray, int, float, complex)):
-            out_dict[k] *= factor
-        elif isinstance(dict1[k], dict):
-            out_dict[k] = multiply_dict_by_factor(dict1[k], factor)
 
-    return out_dict
+    def __init__(self, theory, state):
+        self._theory = theory
+        self._state = state
+
+    def _resolve(self, key):
+        pending = self._state.get('pending_products')
+        if pending is not None and key in pending.products:
+            self._theory.resolve_product(self._state, key)
+
+    def _resolve_all(self):
+        pending = self._state.get('pending_products')
+        for key in list(pending.products if pending is not None else []):
+            self._theory.resolve_product(self._state, key)
+
+    def __getitem__(self, key):
+        self._resolve(key)
+        return self._state[key]
+
+    def __setitem__(self, key, value):
+        self._state[key] = value
+
+    def __contains__(self, key):
+        pending = self._state.get('pending_products')
+        return key in self._state or (pending is not None and key in pending.products)
+
+    def get(self, key, default=None):
+        self._resolve(key)
+        return self._state.get(key, default)
+
+    def keys(self):
+        self._resolve_all()
+        return self._state.keys()
+
+    def items(self):
+        self._resolve_all()
+        return self._state.items()
+
+    def values(self):
+        self._resolve_all()
+        return self._state.values()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
 
 
 class CobayaCAMB_mnuEff(CAMBBase):
+    # Number of massless-neutrino transfer results kept in memory (0 disables the cache)
+    massless_cache_size: int = 4
+    # Run the massless and |mnu_eff| CAMB solves of negative mnu_eff steps concurrently,
+    # the latter in a spawned worker process holding its own copy of this theory (not
+    # available if the theory depends on other theory components, e.g. an external
+    # primordial power spectrum)
+    parallel_transfers: bool = False
+    # Total number of OpenMP threads split between the two concurrent solves
+    # (by default OMP_NUM_THREADS)
+    parallel_threads: Optional[int] = None
+    # Use CAMB's massless neutrino configuration (no massive species, same N_eff) for the
+    # massless runs instead of mnu = 1e-10. About twice as fast, but the massless and
+    # massive neutrino treatments differ at the 1e-3 level in the CMB spectra, which
+    # shows up as a step at mnu_eff = 0 when extrapolating from the massive |mnu_eff| runs
+    exact_massless: bool = False
+    # Directory of a persistent cache of theory products, shared between runs and
+    # processes (null disables it). Best placed on node-local storage.
+    disk_cache: Optional[str] = None
+    # Maximum size of the persistent cache, in MB
+    disk_cache_max_mb: float = 2048
+    # Cheaper CAMB settings used before the configured ones, e.g. during burn-in: a dict
+    # with the 'stages' and the sampler's 'progress_file' (see README). Points computed
+    # with them have a negative 'accuracy_stage' derived parameter.
+    accuracy_ladder: Optional[dict] = None
+    # Prefix of the per-rank counters and timers written at the end of the run (usually
+    # the output prefix of the chain), merged with `python -m disputauble.timing_report`
+    stats_output: Optional[str] = None
+    # Keep the CAMB results of only this many of the most recent transfer states, and
+    # compute the products of negative mnu_eff steps straight away rather than on demand,
+    # so that the other cached states only hold output arrays (null keeps all; use at
+    # least 2 with MCMC dragging, which alternates between two sets of slow parameters).
+    # The massless cache then keeps at most this many results too
+    lean_states: Optional[int] = None
+    # Fast approximate mode: the products at mnu_eff = 0 and mnu_eff_table_step are
+    # computed once per set of slow parameters, and interpolated linearly in mnu_eff
+    # (extrapolated through zero for negative mnu_eff), so that mnu_eff becomes a fast
+    # parameter. Points where the interpolation fails its accuracy check are computed exactly
+    mnu_eff_table: bool = False
+    # Spacing of the table in eV; a third point at twice this mass is used to estimate the
+    # error of the interpolation, which is only used for |mnu_eff| <= 2 * mnu_eff_table_step
+    mnu_eff_table_step: float = 0.1
+    # Largest estimated error of the interpolation, relative to the largest absolute value
+    # of each product, above which the exact calculation is used instead
+    mnu_eff_table_tolerance: float = 1e-3
+    # Factor applied to the estimated error before comparing it to the tolerance. The
+    # estimate only includes the quadratic term, and was found to be low by up to 1.5
+    # (at mnu_eff = -0.05 with the default step), so the table is trusted to about
+    # mnu_eff_table_tolerance only with a factor of at least 2
+    mnu_eff_table_safety: float = 3
+    # The table costs three transfer solves per set of slow parameters (two if the massless
+    # one is cached), an exact positive mnu_eff one. Positive mnu_eff at least this far
+    # from zero are computed exactly, and the table is only built once a point (e.g. a
+    # fast step) comes closer to zero or is negative (null: mnu_eff_table_step)
+    mnu_eff_table_margin: Optional[float] = None
+
+    # Derived parameters that do not depend on the neutrino mass, taken from the massless
+    # run instead of being extrapolated
+    _mnu_independent_derived = frozenset(['As', 'ns', 'nrun', 'nrunrun', 'r', 'YHe', 'Y_p', 'TCMB',
+                                          'accuracy_stage'])
+
+    def initialize(self):
+        super().initialize()
+        self._worker = None
+        # requests received through must_provide, to build the copy of the parallel worker
+        self._requests = []
+        self._combiner = LinearCombiner()
+        self.run_stats = RunStats()
+        # pending products whose parameters were the last ones set on their CAMBdata
+        self._power_set_for = None
+        self._disk_cache = None
+        if self.disk_cache:
+            self._disk_cache = ResultsDiskCache(self.disk_cache, max_bytes=int(self.disk_cache_max_mb * 2 ** 20))
+        self._accuracy = None
+        # extra_args of the production stage, only known once all requirements are set
+        self._production_extra_args = None
+        if self.lean_states is not None and self.lean_states < 1:
+            raise LoggedError(self.log, "lean_states must be at least 1 (the current state), got %r",
+                              self.lean_states)
+        if self.accuracy_ladder:
+            try:
+                self._accuracy = AccuracyLadder(self.accuracy_ladder.get('stages') or [],
+                                                self.accuracy_ladder.get('progress_file'))
+            except ValueError as e:
+                raise LoggedError(self.log, "Invalid accuracy_ladder: %s", e)
+        if self.mnu_eff_table and not self.mnu_eff_table_step > 0:
+            raise LoggedError(self.log, "mnu_eff_table_step must be positive, got %r", self.mnu_eff_table_step)
+        if self.mnu_eff_table and self.mnu_eff_table_safety < 1:
+            raise LoggedError(self.log, "mnu_eff_table_safety must be at least 1, got %r", self.mnu_eff_table_safety)
+
+    def initialize_with_params(self):
+        super().initialize_with_params()
+        if self.mnu_eff_table and 'mnu_eff' not in self.input_params:
+            raise LoggedError(self.log, "mnu_eff_table needs mnu_eff as an input parameter")
 
     def calculate(self, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the theory predictions for the given parameters, or load them from the
+        persistent cache if enabled.
+
+        Parameters
+        ----------
+        state : dict
+            Dictionary to store the results of the calculation.
+        want_derived : bool
+            Whether to calculate derived parameters.
+        params_values_dict : dict
+            Dictionary of parameter values.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        if self._disk_cache is None:
+            return self.calculate_products(state, want_derived=want_derived, **params_values_dict)
+
+        key = self.disk_cache_key(params_values_dict)
+        cached = self._disk_cache.get(key)
+        if cached is not None:
+            self.log.debug("Loaded theory products from the persistent cache")
+            state.update(cached)
+            return None
+
+        # the transfer functions are only computed when the products are not cached
+        if self._camb_transfers.calculate_deferred() is False:
+            return False
+        # derived parameters are always computed so that the cached products are complete
+        if self.calculate_products(state, want_derived=True, **params_values_dict) is False:
+            return False
+        self.resolve_all_products(state)
+        products = {k: v for k, v in state.items() if k not in ('params', 'dependency_params')}
+        if not self._disk_cache.put(key, products):
+            self.log.debug("Theory products could not be stored in the persistent cache")
+        return None
+
+    def disk_cache_key(self, params_values_dict):
+        """
+        Key of the persistent cache: hash of all input parameters (including those of the
+        transfer helper), the CAMB settings and the requested products. It does not depend
+        on the hash seed, so that it is the same in all processes.
+        """
+        transfers = self._camb_transfers
+        collectors = {k: (getattr(c.method, '__qualname__', repr(c.method)), _sort_lists(c.args),
+                          _sort_lists(c.kwargs)) for k, c in self.collectors.items()}
+        return hash_key(_freeze((params_values_dict, transfers.current_state['params'], self.extra_args,
+                                 self.extra_attrs, transfers.needs_perts, transfers.non_linear_sources,
+                                 collectors, list(self.output_params), self.derived_extra,
+                                 self.exact_massless, self.current_accuracy_stage(), self.get_version())))
+
+    def calculate_products(self, state, want_derived=True, **params_values_dict):
         """
         Calculate the theory predictions for the given parameters.
 
@@ -55,28 +284,436 @@ class CobayaCAMB_mnuEff(CAMBBase):
         None
         """
 
+        self._power_set_for = None
+        branch = self._camb_transfers.current_state.get('branch', 'positive')
+        self.run_stats.count('products.' + branch)
+        with self.run_stats.timer('products.' + branch):
+            if self.calculate_branch_products(state, want_derived=want_derived, **params_values_dict) is False:
+                return False
+        if self.lean_states:
+            # the products no longer need the CAMB results, which can then be released
+            self.resolve_all_products(state)
+            self._power_set_for = None
+            self._camb_transfers.release_results(keep=self.lean_states)
+        return None
+
+    def calculate_branch_products(self, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the theory predictions from the transfer functions of the current state
+        of the transfer helper, extrapolating for negative mnu_eff.
+        """
         transfers = self._camb_transfers.current_state
-        if 'results' in transfers:
+        if 'table_params' in transfers:
+            return self.calculate_from_table(state, transfers, want_derived=want_derived, **params_values_dict)
+        if 'results_mnu_abs' not in transfers:
             self.log.debug("CAMB calculate called with positive neutrino mass")
-            super().calculate(state, want_derived=want_derived, **params_values_dict)
-        else:
-            self.log.debug("CAMB calculate called with negative neutrino mass")
-            assert 'results_mnu_abs' in transfers and 'results_mnu_0' in transfers, "CAMB transfers must be calculated before using mnu extrapolation."
+            return super().calculate(state, want_derived=want_derived, **params_values_dict)
 
-            self._camb_transfers.current_state['results'] = transfers['results_mnu_abs']
-            mnu_abs_state = {}
-            super().calculate(mnu_abs_state, want_derived=want_derived, **params_values_dict)
+        self.log.debug("CAMB calculate called with negative neutrino mass")
+        assert 'results_mnu_0' in transfers, "CAMB transfers must be calculated before using mnu extrapolation."
 
-            self._camb_transfers.current_state['results'] = transfers['results_mnu_0']
+        mnu_abs_results = transfers['results_mnu_abs']
+        if not isinstance(mnu_abs_results, RemoteResults):
+            return self.calculate_extrapolated(state, (transfers['results_mnu_0'], mnu_abs_results),
+                                               want_derived=want_derived, **params_values_dict)
+
+        # the |mnu_eff| transfers are held by the worker process, which computes their products
+        mnu_abs_results.worker.submit_products(mnu_abs_results, want_derived, params_values_dict)
+        try:
             mnu_0_state = {}
-            super().calculate(mnu_0_state, want_derived=want_derived, **params_values_dict)
+            with camb_threads(self.camb, mnu_abs_results.worker.main_threads):
+                mnu_0_ok = self.calculate_from_transfers(transfers['results_mnu_0'], mnu_0_state,
+                                                         want_derived=want_derived, **params_values_dict)
+        finally:
+            mnu_abs_state = mnu_abs_results.worker.receive()
+        if mnu_0_ok is False or mnu_abs_state is False:
+            return False
+
+        # 2 * X(0) - X(|mnu_eff|), written into the freshly computed mnu_abs_state arrays
+        with self.run_stats.timer('extrapolation'):
+            state.update(self._combiner.combine((2, -1), (mnu_0_state, mnu_abs_state), owned=1))
+
+    def calculate_from_table(self, state, transfers, want_derived=True, **params_values_dict):
+        """
+        Calculate the theory predictions by linear interpolation in mnu_eff between the
+        products at the first two points of the derivative table (extrapolating through
+        zero for negative mnu_eff, as 2 * X(0) - X(|mnu_eff|) does). The table is built
+        the first time it is needed for a set of slow parameters, and its products once
+        for each set of power spectrum parameters.
 
-            state.update(difference_dicts(multiply_dict_by_factor(mnu_0_state, 2), mnu_abs_state))
+        The error of the interpolation is estimated from the second difference of the
+        table, and the exact calculation is used if it is above mnu_eff_table_tolerance
+        (after multiplying it by mnu_eff_table_safety), for |mnu_eff| beyond twice the
+        table step, and for positive mnu_eff beyond mnu_eff_table_margin when the table
+        has not been built.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        power_params = {p: v for p, v in params_values_dict.items() if p != 'mnu_eff'}
+        mnu_eff = params_values_dict['mnu_eff']
+        margin = self.mnu_eff_table_step if self.mnu_eff_table_margin is None else self.mnu_eff_table_margin
+        if 'results_table' not in transfers and mnu_eff >= margin:
+            self.run_stats.count('table.skipped')
+            return self.calculate_table_exact(state, transfers, mnu_eff, power_params)
+
+        table = transfers.get('table_products')
+        if table is None or table[0] != power_params:
+            with self.run_stats.timer('table.transfers'):
+                results_table = self._camb_transfers.table_results(transfers)
+            if results_table is None:
+                return False
+            products = []
+            with self.run_stats.timer('table.products'):
+                for results in results_table:
+                    products.append({})
+                    # derived parameters are always computed, so that all points have the same structure
+                    if self.calculate_from_transfers(results, products[-1], want_derived=True, **power_params) is False:
+                        return False
+            table = (power_params, products, relative_second_difference(products))
+            transfers['table_products'] = table
+        _, products, second_difference = table
+
+        t = abs(mnu_eff) / self.mnu_eff_table_step
+        error = self.mnu_eff_table_safety * t * abs(t - 1) / 2 * second_difference
+        if t <= 2 and error <= self.mnu_eff_table_tolerance:
+            self.run_stats.count('table.hits')
+            with self.run_stats.timer('extrapolation'):
+                weight = np.sign(mnu_eff) * t
+                state.update(self._combiner.combine((1 - weight, weight), products[:2]))
+            return None
+
+        self.run_stats.count('table.fallbacks')
+        self.log.debug("Derivative table not accurate enough at mnu_eff = %g, computing it exactly", mnu_eff)
+        return self.calculate_table_exact(state, transfers, mnu_eff, power_params, massless=products[0])
+
+    def calculate_table_exact(self, state, transfers, mnu_eff, power_params, massless=None):
+        """
+        Calculate the theory predictions at mnu_eff exactly, from transfer functions at
+        |mnu_eff| kept with the table state (so that fast steps of the other parameters
+        do not solve them again), and the massless products of the table for negative mnu_eff.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        with self.run_stats.timer('table.exact'):
+            results = self._camb_transfers.exact_results(transfers, abs(mnu_eff))
+            if results is None:
+                return False
+            exact = {}
+            if self.calculate_from_transfers(results, exact, want_derived=True, **power_params) is False:
+                return False
+        if mnu_eff < 0:
+            exact = self._combiner.combine((2, -1), (massless, exact), owned=1)
+        state.update(exact)
+        return None
+
+    def calculate_extrapolated(self, state, results, want_derived=True, **params_values_dict):
+        """
+        Calculate the extrapolation 2 * X(0) - X(|mnu_eff|) from the massless and
+        |mnu_eff| transfer results. Derived parameters are computed straight away (those
+        that do not depend on the neutrino mass from the massless run only), while the
+        requested products are only computed when first accessed.
+
+        Parameters
+        ----------
+        state : dict
+            Dictionary to store the results of the calculation.
+        results : tuple
+            Massless and |mnu_eff| transfer results (CAMBparams and CAMBdata instances).
+        want_derived : bool
+            Whether to calculate derived parameters.
+        params_values_dict : dict
+            Dictionary of parameter values.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        pending = _PendingProducts(results, params_values_dict, set(self.collectors))
+        if self.set_power_spectra(pending) is False:
+            return False
+
+        names = [self.translate_param(p) for p in self.output_params] if want_derived else []
+        names += self.derived_extra
+        mnu_0_outputs = CAMBOutputs(results[0][0], results[0][1], results[0][1].get_derived_params())
+        mnu_abs_outputs = None
+        if any(p not in self._mnu_independent_derived for p in names):
+            mnu_abs_outputs = CAMBOutputs(results[1][0], results[1][1], results[1][1].get_derived_params())
+
+        def extrapolated_derived(p):
+            value = self._get_derived(p, mnu_0_outputs)
+            if p in self._mnu_independent_derived or value is None:
+                return value
+            return 2 * value - self._get_derived(p, mnu_abs_outputs)
+
+        if want_derived:
+            state['derived'] = {}
+            for p in self.output_params:
+                state['derived'][p] = extrapolated_derived(self.translate_param(p))
+                if state['derived'][p] is None:
+                    raise LoggedError(self.log, "Derived param '%s' not implemented in the CAMB interface", p)
+        state['derived_extra'] = {p: extrapolated_derived(p) for p in self.derived_extra}
+        if pending.products:
+            state['pending_products'] = pending
+
+    def set_power_spectra(self, pending):
+        """
+        Set the initial power spectrum and non-linear model parameters of the massless and
+        |mnu_eff| transfer results, and compute their power spectra.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        self._power_set_for = None
+        if not (self.collectors or "sigma8" in self.derived_extra):
+            self._power_set_for = pending
+            return None
+        params_values_dict = pending.params_values_dict
+        try:
+            for _, results in pending.results:
+                if self.external_primordial_pk and self.needs_perts:
+                    primordial_pk = self.provider.get_primordial_scalar_pk()
+                    if primordial_pk.get("log_regular", True):
+                        results.Params.InitPower.set_scalar_log_regular(
+                            primordial_pk["kmin"], primordial_pk["kmax"], primordial_pk["Pk"])
+                    else:
+                        results.Params.InitPower.set_scalar_table(primordial_pk["k"], primordial_pk["Pk"])
+                    results.Params.InitPower.effective_ns_for_nonlinear = primordial_pk.get(
+                        "effective_ns_for_nonlinear", 0.97)
+                    if self.extra_attrs.get("WantTensors"):
+                        primordial_pk = self.provider.get_primordial_tensor_pk()
+                        if primordial_pk.get("log_regular", True):
+                            results.Params.InitPower.set_tensor_log_regular(
+                                primordial_pk["kmin"], primordial_pk["kmax"], primordial_pk["Pk"])
+                        else:
+                            results.Params.InitPower.set_tensor_table(primordial_pk["k"], primordial_pk["Pk"])
+                else:
+                    args = {self.translate_param(p): v for p, v in params_values_dict.items() if p in self.power_params}
+                    args.update(self.initial_power_args)
+                    results.Params.InitPower.set_params(**args)
+                if self.non_linear_sources or self.non_linear_pk:
+                    if self.use_non_linear_ratio:
+                        non_linear_ratio = self.provider.get_non_linear_ratio(results)
+                        results.Params.NonLinearModel.set_ratio(
+                            non_linear_ratio["k_h"], non_linear_ratio["z"], non_linear_ratio["ratio"])
+                    else:
+                        args = {self.translate_param(p): v for p, v in params_values_dict.items()
+                                if p in self.nonlin_params}
+                        args.update(self.nonlin_args)
+                        results.Params.NonLinearModel.set_params(**args)
+                results.power_spectra_from_transfer()
+                if "sigma8" in params_values_dict:
+                    sigma8 = results.get_sigma8_0()
+                    results.Params.InitPower.As *= params_values_dict["sigma8"] ** 2 / sigma8 ** 2
+                    results.power_spectra_from_transfer()
+        except self.camb.baseconfig.CAMBError as e:
+            if self.stop_at_error:
+                self.log.error("Computation error (see traceback below)! Parameters sent to CAMB: %r and %r.\n"
+                               "To ignore this kind of error, make 'stop_at_error: False'.",
+                               params_values_dict, dict(self.extra_args))
+                raise
+            self.log.debug("Computation of cosmological products failed. Assigning 0 likelihood and going on. "
+                           "The output of the CAMB error was %s", e)
+            return False
+        self._power_set_for = pending
+        return None
+
+    def resolve_product(self, state, product):
+        """
+        Compute a pending product of a negative mnu_eff state and store it in the state.
+        """
+        pending = state['pending_products']
+        with self.run_stats.timer('products.negative.on_demand'):
+            if self._power_set_for is not pending:
+                # another calculation has changed the power spectra of the transfer results since
+                if self.set_power_spectra(pending) is False:
+                    raise LoggedError(self.log, "Failed to recompute the power spectra for %r", product)
+            collector = self.collectors[product]
+            values = []
+            for _, results in pending.results:
+                value = collector.method(results, *collector.args, **collector.kwargs)
+                if collector.post:
+                    value = collector.post(*value)
+                values.append(value)
+            with self.run_stats.timer('extrapolation'):
+                state[product] = self._combiner.combine((2, -1), values, owned=1)
+        pending.products.discard(product)
+        if not pending.products:
+            del state['pending_products']
+
+    def resolve_all_products(self, state):
+        """
+        Compute all pending products of a state.
+        """
+        while 'pending_products' in state:
+            self.resolve_product(state, next(iter(state['pending_products'].products)))
+
+    @property
+    def current_state(self):
+        state = super().current_state
+        if 'pending_products' in state:
+            return _ResolvingState(self, state)
+        return state
+
+    def calculate_from_transfers(self, results, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the theory predictions from the given transfer results rather than
+        the ones in the current state of the transfer helper.
+
+        Parameters
+        ----------
+        results : tuple
+            CAMBparams and CAMBdata instances, as stored by the transfer helper.
+        state : dict
+            Dictionary to store the results of the calculation.
+        want_derived : bool
+            Whether to calculate derived parameters.
+        params_values_dict : dict
+            Dictionary of parameter values.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        self._camb_transfers.results_override = results
+        try:
+            return super().calculate(state, want_derived=want_derived, **params_values_dict)
+        finally:
+            self._camb_transfers.results_override = None
+
+    def current_accuracy_stage(self):
+        """
+        Get the current accuracy stage: negative while cheaper CAMB settings are used,
+        0 with the configured (production) ones.
+        """
+        return self._accuracy.stage if self._accuracy is not None else 0
+
+    def update_accuracy_stage(self):
+        """
+        Called by the transfer helper before each new transfer calculation: step up the
+        accuracy stage if one of its triggers is met, and apply its CAMB settings.
+        """
+        if self._accuracy is None:
+            return
+        first = self._production_extra_args is None
+        if first:
+            # all requirements have been set by the first calculation
+            self._production_extra_args = deepcopy(self.extra_args)
+        if self._accuracy.step(self.previous_loglike()) or first:
+            self.apply_accuracy_stage()
+
+    def apply_accuracy_stage(self):
+        """
+        Set the CAMB settings of the current accuracy stage, discarding everything
+        computed with the settings of the previous one.
+        """
+        extra_args = self._accuracy.extra_args(self._production_extra_args)
+        self.log.info("Accuracy stage %d: using CAMB settings %r", self._accuracy.stage,
+                      {k: v for k, v in extra_args.items() if k != 'redshifts'})
+        self.extra_args.clear()
+        self.extra_args.update(extra_args)
+        self._base_params = None
+        self._camb_transfers.clear_massless_cache()
+        if self._worker is not None:
+            # the worker holds a copy of the old settings
+            self._worker.close()
+            self._worker = None
+        for component in self.provider.model.components:
+            component._states.clear()
+
+    def previous_loglike(self):
+        """
+        Get the total log-likelihood of the last point evaluated by the model, or None
+        if not available.
+        """
+        try:
+            return sum(like.current_logp for like in self.provider.model.likelihood.values())
+        except (LoggedError, KeyError, AttributeError):
+            return None
+
+    def get_can_support_params(self):
+        params = super().get_can_support_params()
+        # with the derivative table, mnu_eff is only used by this theory (as a fast parameter)
+        return params + ['mnu_eff'] if self.mnu_eff_table else params
+
+    def get_can_provide_params(self):
+        return super().get_can_provide_params() | {'accuracy_stage'}
+
+    def _get_derived(self, p, intermediates):
+        if p == 'accuracy_stage':
+            return float(self.current_accuracy_stage())
+        return super()._get_derived(p, intermediates)
+
+    def parallel_worker(self):
+        """
+        Get the worker process running the |mnu_eff| solves, starting it if needed.
+        The worker builds its copy of the theory from worker_info(), which is only
+        complete once the model is, so it is started at the first negative mnu_eff step.
+        """
+        if self._worker is None:
+            self._worker = CambWorker(partial(build_worker_theory, self.worker_info()), self.parallel_threads,
+                                      cache_size=self.lean_states or max(self.massless_cache_size, 4))
+            self.log.debug("Started CAMB worker process, with %d OpenMP threads left to the main process",
+                           self._worker.main_threads)
+        return self._worker
+
+    def worker_info(self):
+        """
+        Get what build_worker_theory needs to build a copy of this theory in another
+        process: its input info and parameters, the requests it received, and its
+        current CAMB settings and accuracy stage.
+        """
+        if self.external_primordial_pk or self.use_non_linear_ratio:
+            raise LoggedError(self.log, "parallel_transfers is not available with an external primordial "
+                                        "power spectrum or non-linear ratio")
+        info = self.provider.model.info()
+        # the worker only computes transfers and products: it never steps its accuracy
+        # ladder, whose stage is set from the main process
+        theory_info = dict(info['theory'][self.get_name()], parallel_transfers=False, disk_cache=None,
+                           stats_output=None)
+        params = {p: 0.0 for p in list(self.input_params) + list(self._camb_transfers.input_params)}
+        params.update({p: {'derived': True} for p in self.output_params})
+        return {'name': self.get_name(), 'theory': theory_info, 'params': params,
+                'packages_path': info.get('packages_path'), 'requests': deepcopy(self._requests),
+                'extra_args': deepcopy(self.extra_args), 'extra_attrs': deepcopy(self.extra_attrs),
+                'accuracy_stage': self.current_accuracy_stage()}
+
+    def close(self, *args):
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+        if self.stats_output:
+            self.dump_run_stats()
+        super().close(*args)
+
+    def dump_run_stats(self):
+        """
+        Write the counters and timers of this process next to the run output.
+        """
+        from cobaya.mpi import get_mpi_rank
+        caches = {'massless_cache': self._camb_transfers.massless_cache_stats}
+        if self._disk_cache is not None:
+            caches['disk_cache'] = self._disk_cache.stats
+        for cache, cache_stats in caches.items():
+            for name, count in cache_stats.items():
+                self.run_stats.counters[f'{cache}.{name}'] = count
+        filename = self.run_stats.dump(self.stats_output, rank=get_mpi_rank() or 0,
+                                       accuracy_stage=self.current_accuracy_stage())
+        self.log.info("Timing summary written to %s", filename)
 
     def must_provide(self, **requirements):
         if 'CAMBdata' in requirements:
-            raise LoggedError("CAMBdata object is not supported when extrapolating mnu to negative masses.")
-
+            raise LoggedError(self.log, "CAMBdata object is not supported when extrapolating mnu to negative masses.")
+        self._requests.append(deepcopy(requirements))
         return super().must_provide(**requirements)
 
     def get_helper_theories(self):
@@ -91,8 +728,44 @@ class CobayaCAMB_mnuEff(CAMBBase):
         return {'camb.transfers_mnuExtrap': self._camb_transfers}
 
 
+def build_worker_theory(worker_info):
+    """
+    Build a copy of a CobayaCAMB_mnuEff theory from its worker_info(), in a model of its
+    own where dummy likelihoods make the same requests, for the parallel worker process.
+    """
+    from cobaya.model import get_model
+    from cobaya.mpi import set_mpi_disabled
+    # the worker is a single process, even if the main one is an MPI rank
+    set_mpi_disabled()
+    name = worker_info['name']
+    likelihoods = {f'_request_{i}': {'external': 'lambda _self: 0.0', 'requires': request}
+                   for i, request in enumerate(worker_info['requests'])
+                   if not set(request).issubset(worker_info['params'])}
+    info = {'theory': {name: worker_info['theory']}, 'params': worker_info['params'], 'likelihood': likelihoods}
+    if worker_info['packages_path']:
+        info['packages_path'] = worker_info['packages_path']
+    theory = get_model(info).theory[name]
+    theory.extra_args.clear()
+    theory.extra_args.update(worker_info['extra_args'])
+    theory.extra_attrs.clear()
+    theory.extra_attrs.update(worker_info['extra_attrs'])
+    theory._base_params = None
+    if theory._accuracy is not None:
+        theory._accuracy.stage = worker_info['accuracy_stage']
+    return theory
+
+
 class CobayaCAMB_transfer_mnuExtrap(CambTransfersBase):
 
+    def __init__(self, cobaya_camb, name, info, timing=None):
+        super().__init__(cobaya_camb, name, info, timing=timing)
+        # LRU cache of massless transfer results, keyed on the non-neutrino parameters
+        # and the CAMB settings (the massless run does not depend on mnu_eff)
+        self._massless_cache = OrderedDict()
+        self.massless_cache_stats = {'hits': 0, 'misses': 0}
+        # transfer results to use instead of the current state (see CobayaCAMB_mnuEff.calculate_from_transfers)
+        self.results_override = None
+
     def get_can_support_params(self):
         """
         Get the parameters that this theory can support.
@@ -102,11 +775,80 @@ class CobayaCAMB_transfer_mnuExtrap(CambTransfersBase):
         set
             Set of parameters that this theory can support.
         """
+        if self.cobaya_camb.mnu_eff_table:
+            # the table is computed at fixed masses, and mnu_eff is used by the main theory
+            return super().get_can_support_params()
         return super().get_can_support_params() | {'mnu_eff'}
 
     def calculate(self, state, want_derived=True, **params_values_dict):
+        self.cobaya_camb.update_accuracy_stage()
+        if self.cobaya_camb.disk_cache:
+            # computed on demand by calculate_deferred, since the products that depend on
+            # these transfer functions may be found in the persistent cache
+            state['deferred'] = (want_derived, params_values_dict)
+            return None
+        return self.calculate_transfers_mnu_eff(state, want_derived=want_derived, **params_values_dict)
+
+    def calculate_deferred(self):
+        """
+        Compute the transfer functions of the current state if their calculation was deferred.
 
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        state = self.current_state
+        if 'deferred' not in state:
+            return None
+        if state.get('deferred_failed'):
+            return False
+        want_derived, params_values_dict = state['deferred']
+        if self.calculate_transfers_mnu_eff(state, want_derived=want_derived, **params_values_dict) is False:
+            state['deferred_failed'] = True
+            return False
+        del state['deferred']
+        return None
+
+    def calculate_transfers_mnu_eff(self, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the transfer functions, translating mnu_eff into CAMB's neutrino mass.
+        For negative mnu_eff, both the massless and |mnu_eff| transfer functions are
+        computed and stored in the state as 'results_mnu_0' and 'results_mnu_abs'. With
+        mnu_eff_table, those of the table are stored as 'results_table' instead.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        branch = 'table' if self.cobaya_camb.mnu_eff_table else self.mnu_eff_branch(params_values_dict)
+        stats = self.cobaya_camb.run_stats
+        stats.count('transfers.' + branch)
+        with stats.timer('transfers.' + branch):
+            if self.calculate_branch_transfers(branch, state, want_derived=want_derived,
+                                               **params_values_dict) is False:
+                return False
+        state['branch'] = branch
+        return None
+
+    @staticmethod
+    def mnu_eff_branch(params_values_dict):
+        """
+        Get the branch of the calculation: 'negative', 'massless' or 'positive' mnu_eff.
+        """
         if params_values_dict.get('mnu_eff', 0.0) < 0.0:
+            return 'negative'
+        return 'massless' if params_values_dict.get('mnu_eff', params_values_dict.get('mnu')) == 0 else 'positive'
+
+    def calculate_branch_transfers(self, branch, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the transfer functions in the given branch of calculate_transfers_mnu_eff.
+        """
+        stats = self.cobaya_camb.run_stats
+        if branch == 'table':
+            return self.calculate_table_transfers(state, want_derived=want_derived, **params_values_dict)
+        if branch == 'negative':
             self.log.debug("CAMB transfers calculate called with negative neutrino mass")
             mnu_abs_param_values_dict = params_values_dict.copy()
             mnu_0_param_values_dict = params_values_dict.copy()
@@ -117,10 +859,30 @@ class CobayaCAMB_transfer_mnuExtrap(CambTransfersBase):
                 del mnu_0_param_values_dict['mnu_eff']
 
             mnu_0_state = state.copy()
-            super().calculate(mnu_0_state, want_derived=want_derived, **mnu_0_param_values_dict)
-
             mnu_abs_state = state.copy()
-            super().calculate(mnu_abs_state, want_derived=want_derived, **mnu_abs_param_values_dict)
+            if (self.cobaya_camb.parallel_transfers
+                    and self.massless_cache_key(mnu_0_param_values_dict) not in self._massless_cache):
+                worker = self.cobaya_camb.parallel_worker()
+                mnu_abs_state['results'] = worker.submit_transfers(mnu_abs_param_values_dict)
+                try:
+                    with camb_threads(self.camb, worker.main_threads), stats.timer('transfers.negative.mnu_0'):
+                        mnu_0_ok = self.calculate_massless(mnu_0_state, want_derived=want_derived,
+                                                           **mnu_0_param_values_dict)
+                finally:
+                    with stats.timer('transfers.negative.mnu_abs_wait'):
+                        mnu_abs_ok = worker.receive()
+                if mnu_0_ok is False or mnu_abs_ok is False:
+                    return False
+            else:
+                with stats.timer('transfers.negative.mnu_0'):
+                    if self.calculate_massless(mnu_0_state, want_derived=want_derived,
+                                               **mnu_0_param_values_dict) is False:
+                        return False
+
+                with stats.timer('transfers.negative.mnu_abs'):
+                    if super().calculate(mnu_abs_state, want_derived=want_derived,
+                                         **mnu_abs_param_values_dict) is False:
+                        return False
 
             state.update({'results_mnu_0': mnu_0_state['results'], 'results_mnu_abs': mnu_abs_state['results']})
         else:
@@ -129,20 +891,168 @@ class CobayaCAMB_transfer_mnuExtrap(CambTransfersBase):
                 params_values_dict['mnu'] = params_values_dict['mnu_eff']
                 del params_values_dict['mnu_eff']
 
-            if params_values_dict['mnu'] == 0:
+            if branch == 'massless':
                 self.log.debug("CAMB transfers calculate called with massless neutrino")
                 self.set_massless_neutrino(params_values_dict)
-            else:
-                self.log.debug("CAMB transfers calculate called with positive neutrino mass")
+                return self.calculate_massless(state, want_derived=want_derived, **params_values_dict)
 
-            super().calculate(state, want_derived=want_derived, **params_values_dict)
+            self.log.debug("CAMB transfers calculate called with positive neutrino mass")
+            return super().calculate(state, want_derived=want_derived, **params_values_dict)
 
-    @staticmethod
-    def set_massless_neutrino(param_dict):
-        param_dict['mnu'] = 1e-10
-        #param_dict['num_nu_massive'] = 0
-        #param_dict['nu_mass_eigenstates'] = 0
-        #param_dict['nu_mass_degeneracies'] = []
-        #param_dict['nu_mass_fractions'] = []
-        #param_dict['nu_mass_numbers'] = []
-        #param_dict['num_massive_neutrinos'] = 0
+    def calculate_table_transfers(self, state, want_derived=True, **params_values_dict):
+        """
+        Prepare the state of the derivative table. Its transfer functions (massless, and
+        with neutrino masses of one and two table steps) and those of exact points are
+        only computed when the main theory asks for them (see table_results and
+        exact_results), since positive mnu_eff far from zero do not need the table.
+        """
+        state['table_params'] = (want_derived, params_values_dict)
+        return None
+
+    def table_results(self, state):
+        """
+        Get the transfer results of the derivative table for the slow parameters of the
+        state, computing them the first time.
+
+        Returns
+        -------
+        tuple or None
+            Massless, one-step and two-step transfer results, or None if the calculation failed.
+        """
+        if 'results_table' in state:
+            return state['results_table']
+        want_derived, params_values_dict = state['table_params']
+        step = self.cobaya_camb.mnu_eff_table_step
+        mnu_0_param_values_dict = params_values_dict.copy()
+        self.set_massless_neutrino(mnu_0_param_values_dict)
+        table = []
+        for i, table_params in enumerate((mnu_0_param_values_dict, dict(params_values_dict, mnu=step),
+                                          dict(params_values_dict, mnu=2 * step))):
+            table_state = {'params': table_params}
+            calculate = self.calculate_massless if i == 0 else self.calculate_transfers
+            if calculate(table_state, want_derived=want_derived, **table_params) is False:
+                return None
+            table.append(table_state['results'])
+        state['results_table'] = tuple(table)
+        return state['results_table']
+
+    def exact_results(self, state, mnu):
+        """
+        Get the transfer results at neutrino mass `mnu` for the slow parameters of the
+        state. The most recent ones (up to massless_cache_size, at least one) are kept in
+        the state.
+
+        Returns
+        -------
+        tuple or None
+            CAMBparams and CAMBdata instances, or None if the calculation failed.
+        """
+        cache = state.setdefault('results_exact', OrderedDict())
+        if mnu in cache:
+            cache.move_to_end(mnu)
+            self.cobaya_camb.run_stats.count('table.exact_reused')
+            return cache[mnu]
+        want_derived, params_values_dict = state['table_params']
+        transfer_params = dict(params_values_dict, mnu=mnu)
+        transfer_state = {'params': transfer_params}
+        if self.calculate_transfers(transfer_state, want_derived=want_derived, **transfer_params) is False:
+            return None
+        cache[mnu] = transfer_state['results']
+        while len(cache) > max(self.cobaya_camb.massless_cache_size, 1):
+            cache.popitem(last=False)
+        return cache[mnu]
+
+    def calculate_transfers(self, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the transfer functions for parameters already translated to CAMB's
+        neutrino mass (i.e. without any mnu_eff handling).
+        """
+        return super().calculate(state, want_derived=want_derived, **params_values_dict)
+
+    def get_CAMB_transfers(self):
+        if self.results_override is not None:
+            return self.results_override
+        return super().get_CAMB_transfers()
+
+    def calculate_massless(self, state, want_derived=True, **params_values_dict):
+        """
+        Calculate the massless neutrino transfer functions, re-using a cached result if
+        the non-neutrino parameters and CAMB settings have been seen before.
+
+        Parameters
+        ----------
+        state : dict
+            Dictionary to store the results of the calculation.
+        want_derived : bool
+            Whether to calculate derived parameters.
+        params_values_dict : dict
+            Dictionary of parameter values, with the neutrino mass already set to zero.
+
+        Returns
+        -------
+        bool or None
+            False if the calculation failed, None otherwise.
+        """
+        cache_size = self.cobaya_camb.massless_cache_size
+        if self.cobaya_camb.lean_states:
+            # the cached massless results hold whole CAMB results too
+            cache_size = min(cache_size, self.cobaya_camb.lean_states)
+        if not cache_size:
+            return super().calculate(state, want_derived=want_derived, **params_values_dict)
+
+        key = self.massless_cache_key(params_values_dict)
+        if key in self._massless_cache:
+            self._massless_cache.move_to_end(key)
+            self.massless_cache_stats['hits'] += 1
+            self.log.debug("Re-using cached massless neutrino transfers")
+            state['results'] = self._massless_cache[key]
+            return None
+
+        self.massless_cache_stats['misses'] += 1
+        if super().calculate(state, want_derived=want_derived, **params_values_dict) is False:
+            return False
+        self._massless_cache[key] = state['results']
+        while len(self._massless_cache) > cache_size:
+            self._massless_cache.popitem(last=False)
+        return None
+
+    def release_results(self, keep):
+        """
+        Remove the cached transfer states beyond the `keep` most recent ones, releasing
+        their CAMB results (they are recomputed if needed again).
+        """
+        stale = list(self._states)[keep:]
+        if not stale:
+            return
+        memory_before = resident_memory_mb()
+        for state in stale:
+            self._states.remove(state)
+            for key in ('results', 'results_mnu_0', 'results_mnu_abs', 'results_table', 'table_products',
+                        'results_exact'):
+                state.pop(key, None)
+        stats = self.cobaya_camb.run_stats
+        stats.count('lean_states.released', len(stale))
+        if memory_before is not None:
+            freed = memory_before - resident_memory_mb()
+            stats.count('lean_states.rss_freed_mb', freed)
+            self.log.debug("Released the CAMB results of %d state(s): %.1f MB resident memory freed per state",
+                           len(stale), freed / len(stale))
+
+    def clear_massless_cache(self):
+        self._massless_cache.clear()
+
+    def massless_cache_key(self, params_values_dict):
+        """
+        Key identifying a massless transfer computation: the parameter values passed to
+        CAMB together with the CAMB settings that affect the transfer functions.
+        """
+        return _freeze((params_values_dict, self.cobaya_camb.extra_args, self.cobaya_camb.extra_attrs,
+                        self.needs_perts, self.non_linear_sources))
+
+    def set_massless_neutrino(self, param_dict):
+        """
+        Set the neutrino mass for the massless run. With zero mass CAMB sets up no massive
+        species and puts all of N_eff in massless neutrinos, so the massive-neutrino
+        hierarchy is not integrated; the legacy setting uses a negligible mass instead.
+        """
+        param_dict['mnu'] = 0.0 if self.cobaya_camb.exact_massless else 1e-10
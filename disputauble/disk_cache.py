@@ -0,0 +1,162 @@
+"""Persistent, size-bounded cache of theory products, shared between processes through a local directory."""
+
+import ast
+import hashlib
+import json
+import numbers
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows: eviction is then not serialised between processes
+    fcntl = None
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def hash_key(frozen):
+    """
+    Hash a hashable (frozen) description of a calculation into a file-name-safe key
+    """
+    return hashlib.sha256(repr(frozen).encode()).hexdigest()
+
+
+def _encode(value, arrays):
+    if isinstance(value, dict):
+        return {'d': [[repr(k), _encode(v, arrays)] for k, v in value.items()]}
+    if isinstance(value, (tuple, list)):
+        return {'t' if isinstance(value, tuple) else 'l': [_encode(v, arrays) for v in value]}
+    if isinstance(value, (np.ndarray, complex, np.complexfloating)):
+        arrays.append(np.asarray(value))
+        return {'a': len(arrays) - 1, 'scalar': not isinstance(value, np.ndarray)}
+    if isinstance(value, (bool, np.bool_)) or value is None or isinstance(value, str):
+        return {'v': value if value is None or isinstance(value, str) else bool(value)}
+    if isinstance(value, numbers.Integral):
+        return {'i': int(value)}
+    if isinstance(value, numbers.Real):
+        return {'f': float(value)}
+    raise _Uncacheable(type(value).__name__)
+
+
+def _decode(tree, arrays):
+    if 'd' in tree:
+        return {ast.literal_eval(k): _decode(v, arrays) for k, v in tree['d']}
+    if 't' in tree:
+        return tuple(_decode(v, arrays) for v in tree['t'])
+    if 'l' in tree:
+        return [_decode(v, arrays) for v in tree['l']]
+    if 'a' in tree:
+        array = arrays[f"a{tree['a']}"]
+        return array[()] if tree['scalar'] else array
+    if 'i' in tree:
+        return tree['i']
+    if 'f' in tree:
+        return tree['f']
+    return tree['v']
+
+
+class ResultsDiskCache:
+    """
+    Directory of .npz files, each holding the theory products for one set of parameters.
+    Arrays are stored as uncompressed binary arrays, and the nesting of the products
+    (dictionaries, tuples, scalars) as a small JSON description.
+
+    Several processes (e.g. MPI ranks on one node) can use the same directory at once:
+    files are written to a temporary name and atomically renamed, unreadable or
+    vanished files count as misses, and only one process at a time evicts the least
+    recently used files once the directory grows beyond `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30, check_every=20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Get the cached products for the key, or None if not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                value = _decode(json.loads(str(data['tree'])), data)
+        except Exception:
+            self.stats['misses'] += 1
+            return None
+        try:
+            # the modification time is used as last access time for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store products in the cache.
+
+        Returns
+        -------
+        bool
+            False if the products could not be stored (e.g. they contain objects that
+            cannot be written as arrays).
+        """
+        arrays = []
+        try:
+            tree = _encode(value, arrays)
+        except _Uncacheable:
+            return False
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, tree=np.array(json.dumps(tree)), **{f'a{i}': a for i, a in enumerate(arrays)})
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        self.stats['stores'] += 1
+        if (self.stats['stores'] - 1) % self.check_every == 0:
+            self.evict()
+        return True
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache is below 90% of its maximum size.
+        """
+        with open(os.path.join(self.directory, '.evict.lock'), 'w') as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # another process is already evicting
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(files):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.stats['evictions'] += 1
+                total -= size
+                if total <= 0.9 * self.max_bytes:
+                    break
@@ -0,0 +1,119 @@
+"""
+Counters and timers of the mnu_eff theory, written per MPI rank at the end of a run.
+
+The per-rank files of a run are merged and summarised with
+
+    python -m disputauble.timing_report <stats_output prefix> [--output merged.json]
+"""
+
+import glob
+import json
+import os
+import platform
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# suffix of the per-rank files, after the stats_output prefix
+FILE_SUFFIX = '.mnu_eff_stats'
+
+
+class RunStats:
+    """
+    Named counters, and timers accumulating the number of calls and the total time.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.timers = {}
+        self._start = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            calls, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (calls + 1, total + time.perf_counter() - start)
+
+    def as_dict(self, **extra):
+        """
+        Get the counters and timers as a JSON-serialisable dictionary.
+        """
+        return {'host': platform.node(), 'wall_s': time.time() - self._start,
+                'counters': dict(self.counters),
+                'timers': {name: {'calls': calls, 'total_s': total} for name, (calls, total) in self.timers.items()},
+                **extra}
+
+    def dump(self, prefix, rank=0, **extra):
+        """
+        Write the counters and timers to ``<prefix>.mnu_eff_stats.<rank>.json``.
+        """
+        filename = f'{prefix}{FILE_SUFFIX}.{rank}.json'
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(rank=rank, **extra), f, indent=1)
+        return filename
+
+
+def resident_memory_mb():
+    """
+    Get the resident memory of this process in MB (None if not available, i.e. not on Linux).
+    """
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def merge(summaries):
+    """
+    Sum the counters, timers and wall time of several per-rank summaries.
+    """
+    merged = {'ranks': 0, 'wall_s': 0.0, 'counters': Counter(), 'timers': {}}
+    for summary in summaries:
+        merged['ranks'] += 1
+        merged['wall_s'] += summary['wall_s']
+        merged['counters'].update(summary['counters'])
+        for name, timer in summary['timers'].items():
+            total = merged['timers'].setdefault(name, {'calls': 0, 'total_s': 0.0})
+            total['calls'] += timer['calls']
+            total['total_s'] += timer['total_s']
+    merged['counters'] = dict(merged['counters'])
+    return merged
+
+
+def load(prefix):
+    """
+    Load and merge all per-rank summaries written with the given prefix.
+    """
+    filenames = sorted(glob.glob(f'{glob.escape(prefix)}{FILE_SUFFIX}.*.json'))
+    if not filenames:
+        raise FileNotFoundError(f"No files {prefix}{FILE_SUFFIX}.*.json")
+    summaries = []
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as f:
+            summaries.append(json.load(f))
+    return merge(summaries)
+
+
+def report(merged):
+    """
+    Format a merged summary as a table, with the fraction of the total wall time (summed
+    over ranks) spent in each timer.
+    """
+    lines = [f"{merged['ranks']} rank(s), {merged['wall_s'] / 3600:.2f} rank-hours in total", '',
+             f"{'timer':<36}{'calls':>10}{'total [h]':>12}{'mean [s]':>10}{'fraction':>10}"]
+    for name, timer in sorted(merged['timers'].items()):
+        calls, total = timer['calls'], timer['total_s']
+        lines.append(f"{name:<36}{calls:>10}{total / 3600:>12.3f}{total / max(calls, 1):>10.3f}"
+                     f"{total / max(merged['wall_s'], 1e-30):>10.1%}")
+    lines += ['', f"{'counter':<36}{'count':>10}"]
+    lines += [f"{name:<36}{count:>10}" for name, count in sorted(merged['counters'].items())]
+    return '\n'.join(lines)
+
@@ -0,0 +1,153 @@
+"""Weighted sums of (nested dictionaries of) theory products, used for the mnu extrapolation."""
+
+import numbers
+
+import numpy as np
+
+
+class InterpolatorCombination:
+    """
+    Weighted sum of interpolator (or other callable) objects, evaluated on demand.
+    Only the ``P(z, k)`` method of power spectrum interpolators is combined in the same
+    way; their other attributes (grids, ranges) must be the same for all of them. Values
+    in log space (``logP``, or calling interpolators of log P directly) are not linear in
+    the products and cannot be combined.
+    """
+
+    # methods of the interpolators that are linear in the products
+    linear_methods = ('P',)
+
+    def __init__(self, weights, interpolators):
+        self.weights = tuple(weights)
+        self.interpolators = tuple(interpolators)
+
+    def __call__(self, *args, **kwargs):
+        if any(getattr(f, 'islog', False) for f in self.interpolators):
+            raise TypeError("Cannot combine interpolators of log P linearly: use P(z, k)")
+        return sum(w * f(*args, **kwargs) for w, f in zip(self.weights, self.interpolators))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        values = [getattr(f, name) for f in self.interpolators]
+        if name in self.linear_methods:
+            return InterpolatorCombination(self.weights, values)
+        if any(callable(v) for v in values):
+            raise AttributeError(f"{name} of the interpolators cannot be combined linearly "
+                                 f"(only {', '.join(self.linear_methods)} can)")
+        first = values[0]
+        for value in values[1:]:
+            assert np.array_equal(value, first), f"Cannot combine values of {name}: {first!r} and {value!r}"
+        return first
+
+
+class LinearCombiner:
+    """
+    Computes weighted sums ``sum_i weights[i] * terms[i]`` of theory products. Terms can
+    be numbers, arrays, interpolators, and tuples, lists or dictionaries of those
+    (nested to any depth); all terms must have the same structure.
+
+    The arrays of the term at index `owned` are overwritten with the result, so that no
+    new output arrays are allocated. All other terms are only read, and the result never
+    shares memory with them. Temporary buffers are kept between calls.
+    """
+
+    def __init__(self):
+        self._scratch = {}
+
+    def combine(self, weights, terms, owned=None):
+        """
+        Compute the weighted sum of the given terms.
+
+        Parameters
+        ----------
+        weights : sequence of float
+            Weight of each term.
+        terms : sequence
+            Terms to combine, all with the same structure.
+        owned : int, optional
+            Index of the term whose arrays may be overwritten with the result.
+
+        Returns
+        -------
+        Weighted sum, with the same structure as the terms.
+        """
+        assert len(weights) == len(terms), "Number of weights and terms do not match"
+        return self._combine(tuple(weights), tuple(terms), owned)
+
+    def _combine(self, weights, terms, owned):
+        first = terms[0]
+        if isinstance(first, dict):
+            for term in terms[1:]:
+                assert isinstance(term, dict) and term.keys() == first.keys(), "Keys of the dictionaries do not match"
+            return {k: self._combine(weights, tuple(term[k] for term in terms), owned) for k in first}
+        if isinstance(first, (tuple, list)):
+            for term in terms[1:]:
+                assert len(term) == len(first), "Lengths of the sequences do not match"
+            return type(first)(self._combine(weights, tuple(term[i] for term in terms), owned)
+                               for i in range(len(first)))
+        if isinstance(first, np.ndarray):
+            return self._combine_arrays(weights, terms, owned)
+        if isinstance(first, numbers.Number) and not isinstance(first, bool):
+            return sum(w * x for w, x in zip(weights, terms))
+        if callable(first):
+            return InterpolatorCombination(weights, terms)
+        # anything else (None, strings, flags) must be the same for all terms
+        for term in terms[1:]:
+            assert term == first, f"Cannot combine values {first!r} and {term!r}"
+        return first
+
+    def _combine_arrays(self, weights, terms, owned):
+        terms = tuple(np.asarray(x) for x in terms)
+        shape = terms[0].shape
+        assert all(x.shape == shape for x in terms), "Shapes of the arrays do not match"
+        dtype = np.result_type(*terms, *weights)
+
+        out = terms[owned] if owned is not None else None
+        if (out is None or out.dtype != dtype or not out.flags.writeable
+                or any(np.may_share_memory(out, x) for i, x in enumerate(terms) if i != owned)):
+            out = np.multiply(terms[0], weights[0], dtype=dtype)
+            others = range(1, len(terms))
+        else:
+            if weights[owned] != 1:
+                np.multiply(out, weights[owned], out=out)
+            others = (i for i in range(len(terms)) if i != owned)
+
+        for i in others:
+            w, x = weights[i], terms[i]
+            if w == 1:
+                np.add(out, x, out=out)
+            elif w == -1:
+                np.subtract(out, x, out=out)
+            elif w != 0:
+                scratch = self._get_scratch(shape, dtype)
+                np.multiply(x, w, out=scratch)
+                np.add(out, scratch, out=out)
+        return out
+
+    def _get_scratch(self, shape, dtype):
+        key = (shape, dtype.str)
+        if key not in self._scratch:
+            self._scratch[key] = np.empty(shape, dtype=dtype)
+        return self._scratch[key]
+
+
+def relative_second_difference(terms):
+    """
+    Largest absolute second difference ``terms[2] - 2 * terms[1] + terms[0]`` of three
+    terms with the same structure (as in LinearCombiner), relative to the largest
+    absolute value of each number or array. Interpolators and other values are skipped.
+    """
+    first = terms[0]
+    if isinstance(first, dict):
+        return np.max([relative_second_difference(tuple(term[k] for term in terms)) for k in first], initial=0.0)
+    if isinstance(first, (tuple, list)):
+        return np.max([relative_second_difference(tuple(term[i] for term in terms)) for i in range(len(first))],
+                      initial=0.0)
+    if isinstance(first, np.ndarray) or isinstance(first, numbers.Number) and not isinstance(first, bool):
+        x0, x1, x2 = (np.asarray(x) for x in terms)
+        scale = max(np.max(np.abs(x), initial=0.0) for x in (x0, x1, x2))
+        if not scale:
+            return 0.0
+        return float(np.max(np.abs(x2 - 2 * x1 + x0), initial=0.0) / scale)
+    return 0.0
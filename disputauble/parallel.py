@@ -0,0 +1,192 @@
+"""Worker processes running CAMB: the |mnu_eff| solve concurrently with the massless one, and pools of models."""
+
+import multiprocessing
+import os
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, NamedTuple
+
+
+class RemoteResults(NamedTuple):
+    """
+    Handle to CAMB transfer results held by a CambWorker (CAMBdata objects cannot be
+    sent between processes, so they stay in the worker and are referred to by token)
+    """
+    worker: Any
+    token: int
+
+
+def total_threads():
+    """
+    Number of OpenMP threads available to this process (OMP_NUM_THREADS, or the number of CPUs)
+    """
+    return int(os.environ.get('OMP_NUM_THREADS') or os.cpu_count() or 1)
+
+
+@contextmanager
+def camb_threads(camb, threads):
+    """
+    Temporarily set the number of OpenMP threads used by CAMB. CAMB only calls
+    omp_set_num_threads for a non-zero ThreadNum, so the default of zero is restored
+    as an explicit thread count.
+    """
+    previous = camb.config.ThreadNum
+    camb.config.ThreadNum = threads
+    try:
+        yield
+    finally:
+        camb.config.ThreadNum = previous or total_threads()
+
+
+def spawn_context():
+    """
+    Get the multiprocessing context of the worker processes that run CAMB. They are
+    spawned rather than forked: with GNU libgomp, a process forked after its parent has
+    run an OpenMP region (any CAMB solve) hangs in its own first OpenMP region, so the
+    workers build their own copy of the model or theory instead of inheriting it.
+    """
+    return multiprocessing.get_context('spawn')
+
+
+def pool_model(info, threads):
+    """
+    Build the Cobaya model of `info` in a spawned pool process, as a single process
+    (with MPI disabled) whose CAMB solves use `threads` OpenMP threads. Pool processes
+    cannot start processes of their own, so the parallel transfer worker is disabled.
+    """
+    from cobaya.model import get_model
+    from cobaya.mpi import set_mpi_disabled
+    from .cobaya_CAMB_mnuEff import CobayaCAMB_mnuEff
+    set_mpi_disabled()
+    model = get_model(info)
+    for theory in model.theory.values():
+        if isinstance(theory, CobayaCAMB_mnuEff):
+            theory.parallel_transfers = False
+        if hasattr(theory, 'camb'):
+            theory.camb.config.ThreadNum = threads
+    return model
+
+
+class CambWorker:
+    """
+    Spawned process holding its own copy of a CobayaCAMB_mnuEff theory, built by the
+    picklable callable `make_theory`. It computes transfer functions on request, keeps
+    the resulting CAMBdata objects, and computes the power spectra and derived
+    parameters from them when asked.
+
+    Requests are asynchronous: every submit_* call must be followed by exactly one
+    call to receive(). The OpenMP threads (by default OMP_NUM_THREADS) are split
+    between the worker and the main process, which should run its own solves with
+    ``camb_threads(camb, worker.main_threads)``.
+    """
+
+    def __init__(self, make_theory, threads=None, cache_size=4, max_tokens=64):
+        threads = threads or total_threads()
+        worker_threads = max(1, threads // 2)
+        self.main_threads = max(1, threads - worker_threads)
+        context = spawn_context()
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=_serve,
+                                        args=(make_theory, child_connection, worker_threads, cache_size,
+                                              max_tokens),
+                                        daemon=True)
+        self._process.start()
+        child_connection.close()
+        self._next_token = 0
+
+    def submit_transfers(self, params_values_dict):
+        """
+        Start the transfer function calculation for the given parameters.
+
+        Returns
+        -------
+        RemoteResults
+            Handle to the results, valid once receive() returned successfully.
+        """
+        self._next_token += 1
+        self._connection.send(('transfers', self._next_token, params_values_dict))
+        return RemoteResults(self, self._next_token)
+
+    def submit_products(self, results, want_derived, params_values_dict):
+        """
+        Start the calculation of the theory products from the transfer results
+        referred to by the handle `results`.
+        """
+        self._connection.send(('products', results.token, (want_derived, params_values_dict)))
+
+    def receive(self):
+        """
+        Wait for the last submitted request to finish and return its result (False if
+        the calculation failed).
+        """
+        status, payload = self._connection.recv()
+        if status == 'error':
+            raise RuntimeError("CAMB worker process failed:\n" + payload)
+        return payload
+
+    def close(self):
+        if self._process.is_alive():
+            try:
+                self._connection.send(('close', None, None))
+            except OSError:
+                pass
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._connection.close()
+
+
+def _serve(make_theory, connection, threads, cache_size, max_tokens):
+    try:
+        theory = make_theory()
+    except Exception:
+        # reported as the failure of each request, so that the main process sees it
+        error = traceback.format_exc()
+        while connection.recv()[0] != 'close':
+            connection.send(('error', error))
+        connection.close()
+        return
+    theory.camb.config.ThreadNum = threads
+    transfers = theory._camb_transfers
+    # params are kept for more tokens than results, so that evicted results can be recomputed
+    params = OrderedDict()
+    results = OrderedDict()
+
+    def compute_transfers(token):
+        state = {}
+        if transfers.calculate_transfers(state, **params[token]) is False:
+            return False
+        results[token] = state['results']
+        while len(results) > cache_size:
+            results.popitem(last=False)
+        return True
+
+    while True:
+        command, token, payload = connection.recv()
+        if command == 'close':
+            break
+        try:
+            if command == 'transfers':
+                params[token] = payload
+                while len(params) > max_tokens:
+                    params.popitem(last=False)
+                connection.send(('ok', compute_transfers(token)))
+            elif command == 'products':
+                if token in results:
+                    results.move_to_end(token)
+                elif token not in params:
+                    raise KeyError(f"Transfer results {token} are no longer available")
+                elif compute_transfers(token) is False:
+                    connection.send(('ok', False))
+                    continue
+                want_derived, params_values_dict = payload
+                state = {}
+                ok = theory.calculate_from_transfers(results[token], state, want_derived=want_derived,
+                                                     **params_values_dict)
+                connection.send(('ok', False if ok is False else state))
+            else:
+                raise ValueError(f"Unknown command {command}")
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+    connection.close()
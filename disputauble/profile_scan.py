@@ -0,0 +1,210 @@
+"""
+Profile likelihood of mnu_eff on a grid of values, in a single job.
+
+The grid is first evaluated at fixed values of the other parameters in a pool of spawned
+processes, each building the model from the input info. The negative grid points are
+sent in one chunk per process, so that each process solves the massless transfer
+functions once and finds them in its massless cache for the rest of its chunk, while the
+|mnu_eff| (or positive mass) solves are spread over the processes. The profile
+minimizations over the other parameters, one per grid value, are then run in the same
+pool, each from the starting point: they vary the slow parameters independently, so they
+do not share solves and cost as much as separate minimizations (the scan saves on the
+number of jobs, not on the CAMB solves of the minimizations). E.g.
+
+    python -m disputauble.profile_scan yamls/lcdm_mnu=free_tau=free_cmb-p+cmb-l+bao.yaml \\
+        --grid -0.4 0.2 13 --start chains/lcdm_mnu=free_tau=free_cmb-p+cmb-l+bao.minimum.txt \\
+        --output chains/lcdm_mnu=free_tau=free_cmb-p+cmb-l+bao
+
+writes the profile to ``<output>.profile.txt``.
+"""
+
+import argparse
+import logging
+
+import numpy as np
+from scipy.optimize import minimize
+
+from .cobaya_CAMB_mnuEff import CobayaCAMB_mnuEff
+from .parallel import pool_model, spawn_context, total_threads
+
+# model of the pool process
+_model = None
+
+# used when the input has no minimizer block
+DEFAULT_MINIMIZE = {'method': 'Powell', 'tol': 1e-6, 'options': {'maxfev': 20000}}
+
+
+def _init_process(info, threads):
+    global _model
+    _model = pool_model(info, threads)
+
+
+def _evaluate(points):
+    return [float(_model.logposterior(point).logpost) for point in points]
+
+
+def _minimize(task):
+    mnu_eff, start, scales, bounds, minimize_info = task
+    names = list(start)
+    x0 = np.array([start[p] for p in names])
+
+    def minus_logpost(y):
+        logpost = _model.logpost(dict(zip(names, x0 + y * scales), mnu_eff=mnu_eff))
+        return -logpost if np.isfinite(logpost) else 1e30
+
+    # in units of the reference width, so that the minimizer steps are similar in all directions
+    scaled_bounds = [((low - x) / s, (high - x) / s) for (low, high), x, s in zip(bounds, x0, scales)]
+    result = minimize(minus_logpost, np.zeros(len(names)), bounds=scaled_bounds, method=minimize_info['method'],
+                      tol=minimize_info.get('tol'), options=minimize_info.get('options'))
+    best = dict(zip(names, x0 + result.x * scales), mnu_eff=mnu_eff)
+    logposterior = _model.logposterior(best)
+    return {'params': best, 'minuslogpost': -float(logposterior.logpost),
+            'chi2': -2 * float(np.sum(logposterior.loglikes)), 'nfev': int(result.nfev),
+            'success': bool(result.success)}
+
+
+class ProfileScanner:
+    """
+    Profile likelihood of mnu_eff for a Cobaya model using CobayaCAMB_mnuEff, with
+    mnu_eff as a sampled parameter.
+
+    Parameters
+    ----------
+    info : dict
+        Input info of the model, from which the model is built here and in each pool
+        process.
+    processes : int, optional
+        Number of pool processes (by default the number of OpenMP threads).
+    threads : int, optional
+        Total number of OpenMP threads, split between the processes (by default
+        OMP_NUM_THREADS).
+    """
+
+    def __init__(self, info, processes=None, threads=None):
+        from cobaya.model import get_model
+        self.info = info
+        self.model = model = get_model(info)
+        self.names = list(model.parameterization.sampled_params())
+        if 'mnu_eff' not in self.names:
+            raise ValueError("mnu_eff must be a sampled parameter of the model")
+        threads = threads or total_threads()
+        self.processes = processes or threads
+        self.threads_per_process = max(1, threads // self.processes)
+        self.log = logging.getLogger(self.__class__.__name__)
+        theories = [t for t in model.theory.values() if isinstance(t, CobayaCAMB_mnuEff)]
+        if theories and not theories[0].massless_cache_size:
+            self.log.warning("massless_cache_size is 0, so the massless solve cannot be shared")
+
+    def _pool(self):
+        return spawn_context().Pool(self.processes, initializer=_init_process,
+                                    initargs=(self.info, self.threads_per_process))
+
+    def evaluate(self, point, grid):
+        """
+        Evaluate the log-posterior on the mnu_eff grid, with the other sampled parameters
+        fixed to their values in `point`.
+
+        Returns
+        -------
+        numpy.ndarray
+            Log-posterior at each grid value.
+        """
+        fixed = {p: v for p, v in point.items() if p in self.names and p != 'mnu_eff'}
+        # the negative grid points of a chunk share the massless solve of its process,
+        # through the massless cache; the positive ones are spread one by one
+        negative = [i for i, m in enumerate(grid) if m < 0]
+        chunks = [negative[k::self.processes] for k in range(min(self.processes, len(negative)))]
+        chunks += [[i] for i, m in enumerate(grid) if m >= 0]
+        logpost = np.empty(len(grid))
+        with self._pool() as pool:
+            values = pool.map(_evaluate, [[dict(fixed, mnu_eff=grid[i]) for i in chunk] for chunk in chunks],
+                              chunksize=1)
+        for chunk, chunk_values in zip(chunks, values):
+            logpost[chunk] = chunk_values
+        return logpost
+
+    def profile(self, start, grid, minimize_info=None):
+        """
+        Minimize the posterior over the other sampled parameters at each grid value of
+        mnu_eff, starting from `start` (e.g. the global best fit).
+
+        Returns
+        -------
+        list of dict
+            For each grid value: the best-fit 'params', 'minuslogpost', 'chi2', number
+            of evaluations 'nfev', 'success' of the minimizer, and 'minuslogpost_start'
+            at the starting point.
+        """
+        minimize_info = dict(minimize_info or DEFAULT_MINIMIZE)
+        start_logpost = self.evaluate(start, grid)
+        names = [p for p in self.names if p != 'mnu_eff']
+        indices = [self.names.index(p) for p in names]
+        scales = np.sqrt(self.model.prior.reference_variances())[indices]
+        bounds = self.model.prior.bounds(confidence_for_unbounded=0.9999995)[indices]
+        tasks = [(m, {p: start[p] for p in names}, scales, bounds, minimize_info) for m in grid]
+        with self._pool() as pool:
+            results = pool.map(_minimize, tasks, chunksize=1)
+        for result, logpost in zip(results, start_logpost):
+            result['minuslogpost_start'] = -logpost
+        return results
+
+
+def read_minimum(filename):
+    """
+    Read a Cobaya .minimum.txt (or similar one-row, commented-header) file as a dictionary.
+    """
+    with open(filename, encoding='utf-8') as f:
+        header = [line for line in f if line.startswith('#')][-1]
+    return dict(zip(header[1:].split(), np.atleast_1d(np.loadtxt(filename))))
+
+
+def minimize_settings(info):
+    """
+    Get the scipy minimizer settings (method, tol, options) from the minimizer block of
+    the input, as in defaults/minimizer_precision.yaml.
+    """
+    block = info.get('minimizer') or {}
+    # the yamls include the defaults file under its own top-level key
+    block = block.get('minimizer', block)
+    return block.get('minimize') or DEFAULT_MINIMIZE
+
+
+def write_profile(filename, names, results):
+    columns = ['mnu_eff', 'minuslogpost', 'chi2', 'minuslogpost_start', 'nfev', 'success'] + \
+              [p for p in names if p != 'mnu_eff']
+    rows = [[r['params']['mnu_eff'], r['minuslogpost'], r['chi2'], r['minuslogpost_start'], r['nfev'],
+             int(r['success'])] + [r['params'][p] for p in columns[6:]] for r in results]
+    np.savetxt(filename, np.array(rows), fmt='%.10g', header=' '.join(columns))
+
+
+def main(argv=None):
+    from cobaya.input import load_input
+    parser = argparse.ArgumentParser(description="Profile likelihood of mnu_eff on a grid")
+    parser.add_argument('input', help='Cobaya input yaml file, with mnu_eff sampled')
+    values = parser.add_mutually_exclusive_group(required=True)
+    values.add_argument('--grid', nargs=3, type=float, metavar=('MIN', 'MAX', 'N'),
+                        help='N evenly spaced mnu_eff values')
+    values.add_argument('--values', nargs='+', type=float, help='mnu_eff values')
+    parser.add_argument('--start', help='.minimum.txt file with the starting point (default: reference point)')
+    parser.add_argument('--processes', type=int, help='pool processes (default: OMP_NUM_THREADS)')
+    parser.add_argument('--output', help='output prefix (default: that of the input)')
+    args = parser.parse_args(argv)
+
+    info = load_input(args.input)
+    scanner = ProfileScanner(info, processes=args.processes)
+    model = scanner.model
+    grid = np.linspace(args.grid[0], args.grid[1], int(args.grid[2])) if args.grid else np.array(args.values)
+    if args.start:
+        start = read_minimum(args.start)
+    else:
+        start = dict(zip(scanner.names, model.prior.reference(random_state=0)))
+    results = scanner.profile(start, grid, minimize_settings(info))
+    output = args.output or info.get('output')
+    if not output:
+        parser.error("no output prefix given, and the input has none")
+    write_profile(output + '.profile.txt', scanner.names, results)
+    model.close()
+
+
+if __name__ == '__main__':
+    main()
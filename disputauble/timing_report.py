@@ -0,0 +1,22 @@
+"""Merge and summarise the per-rank counters and timers written with the stats_output option."""
+
+import argparse
+import json
+
+from disputauble.instrumentation import load, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('prefix', help='stats_output prefix of the run (usually its output prefix)')
+    parser.add_argument('--output', help='write the merged summary to this JSON file')
+    args = parser.parse_args(argv)
+    merged = load(args.prefix)
+    print(report(merged))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(merged, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
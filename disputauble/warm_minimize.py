@@ -0,0 +1,284 @@
+"""
+Best fit of a Cobaya model started from its existing chains.
+
+Instead of minimizing from the reference point, several minimizations are started from
+distinct high-posterior samples of the chains, in the coordinates where the chain
+covariance is the identity, and run in a pool of spawned processes, each building the
+model from the input info. Each start is a single minimization, which reports the best
+-log(posterior) it has reached: as soon as the unconverged ones agree with the best minimum
+found to within the tolerance on -log(posterior), all but the best one are stopped, and
+the best one goes on until it converges with the settings of the minimizer block, as a
+single minimization would. E.g.
+
+    OMP_NUM_THREADS=32 python -m disputauble.warm_minimize yamls/w0wa_mnu=0.06_tau=0.06_cmb-p+cmb-l+bao.yaml \\
+        --starts 8
+
+writes ``<output>.minimum.txt`` in the format of Cobaya's minimizer (and the
+``.minimize.input.yaml`` next to it), as read by do_analysis.py.
+"""
+
+import argparse
+import logging
+
+import numpy as np
+from scipy.optimize import minimize
+
+from .parallel import pool_model, spawn_context, total_threads
+from .profile_scan import DEFAULT_MINIMIZE, minimize_settings
+
+# model of the pool process, and the progress shared with the main process: best
+# -log(posterior) of each start, its state (0 waiting, 1 running, 2 done) and stop flag
+_model = None
+_progress = None
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _init_process(info, threads, progress):
+    global _model, _progress
+    _model = pool_model(info, threads)
+    _progress = progress
+
+
+def _minuslogpost(x):
+    logpost = _model.logpost(x)
+    return -logpost if np.isfinite(logpost) else 1e30
+
+
+def _minimize(task):
+    i, x0, transform, minimize_info = task
+    values, state, stop = _progress
+    best = [np.inf, np.zeros(len(x0))]
+    nfev = 0
+
+    def minus_logpost(y):
+        nonlocal nfev
+        if stop[i]:
+            raise _Stopped
+        value = _minuslogpost(x0 + transform @ y)
+        nfev += 1
+        if value < best[0]:
+            best[:] = value, y
+            values[i] = value
+        return value
+
+    # no bounds, since they are not aligned with the axes after the rotation: points outside
+    # the prior have an infinite -log(posterior)
+    options = dict(minimize_info.get('options') or {}, disp=False)
+    state[i] = 1
+    try:
+        result = minimize(minus_logpost, np.zeros(len(x0)), method=minimize_info['method'],
+                          tol=minimize_info.get('tol'), options=options)
+        converged = bool(result.success)
+    except _Stopped:
+        converged = False
+    finally:
+        state[i] = 2
+    return x0 + transform @ best[1], float(best[0]), nfev, converged
+
+
+def chain_starts(samples, names, starts, min_distance=1.0):
+    """
+    Pick the highest-posterior samples of the chains that are at least `min_distance`
+    apart, in units of the chain covariance.
+
+    Parameters
+    ----------
+    samples : getdist.MCSamples
+        The chains (after burn-in removal).
+    names : list of str
+        Sampled parameters of the model, in order.
+    starts : int
+        Number of points.
+    min_distance : float
+        Minimum Mahalanobis distance between the points.
+
+    Returns
+    -------
+    tuple
+        The points (array of shape (starts, len(names)), fewer if the chains do not have
+        enough distinct points), their -log(posterior) and the chain covariance.
+    """
+    missing = [p for p in names if p not in samples.index]
+    if missing:
+        raise ValueError(f"Sampled parameters {missing} are not in the chains")
+    indices = [samples.index[p] for p in names]
+    cov = np.atleast_2d(samples.cov(indices))
+    whiten = np.linalg.inv(np.linalg.cholesky(cov))
+    points = samples.samples[:, indices]
+    chosen = []
+    for i in np.argsort(samples.loglikes):
+        z = whiten @ points[i]
+        if all(np.linalg.norm(z - whiten @ points[j]) >= min_distance for j in chosen):
+            chosen.append(i)
+            if len(chosen) == starts:
+                break
+    return points[chosen], samples.loglikes[chosen], cov
+
+
+class WarmMinimizer:
+    """
+    Minimizer of -log(posterior) of a Cobaya model with several starts taken from its
+    chains.
+
+    Parameters
+    ----------
+    info : dict
+        Input info of the model, from which the model is built here and in each pool
+        process.
+    processes : int, optional
+        Number of pool processes, i.e. of minimizations run at the same time (by default
+        the number of starts).
+    threads : int, optional
+        Total number of OpenMP threads, split between the processes (by default
+        OMP_NUM_THREADS).
+    """
+
+    def __init__(self, info, processes=None, threads=None):
+        from cobaya.model import get_model
+        self.info = info
+        self.model = get_model(info)
+        self.names = list(self.model.parameterization.sampled_params())
+        self.processes = processes
+        self.threads = threads or total_threads()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def _pool(self, processes, progress):
+        return spawn_context().Pool(processes, initializer=_init_process,
+                                    initargs=(self.info, max(1, self.threads // processes), progress))
+
+    def _stop_if_agreeing(self, progress, tol):
+        """
+        Stop all starts but the best one if the running ones agree with it.
+        """
+        values, state, stop = (np.array(a) for a in progress)
+        started = state > 0
+        if started.sum() < 2:
+            return False
+        best = np.min(values[started])
+        if not np.isfinite(best):
+            return False
+        agreeing = started & (values - best <= tol)
+        if agreeing.sum() < 2 or np.any((state == 1) & ~agreeing):
+            return False
+        keep = int(np.argmin(np.where(started, values, np.inf)))
+        self.log.info("%d starts agree to within %g: -log(posterior) %s; going on with start %d only",
+                      agreeing.sum(), tol, ' '.join(f'{v:.4f}' for v in values[started]), keep)
+        for i in range(len(values)):
+            if i != keep:
+                progress[2][i] = 1
+        return True
+
+    def run(self, samples, starts=8, minimize_info=None, tol=0.01, min_distance=1.0, poll=1.0):
+        """
+        Minimize from the best distinct points of the chains.
+
+        Parameters
+        ----------
+        samples : getdist.MCSamples
+            The chains of the model (after burn-in removal).
+        starts : int
+            Number of minimizations.
+        minimize_info : dict, optional
+            scipy minimizer settings (method, tol, options), as in
+            defaults/minimizer_precision.yaml, used for each start.
+        tol : float
+            Agreement in -log(posterior) at which the other minimizations stop; the
+            best one goes on to the tolerance of `minimize_info`.
+        min_distance : float
+            Minimum distance between the starting points, in units of the chain covariance.
+        poll : float
+            Seconds between agreement checks.
+
+        Returns
+        -------
+        dict
+            The best-fit 'params', its 'minuslogpost', the total number of evaluations
+            'nfev', whether the best start 'converged', and 'starts', the (minuslogpost_start, minuslogpost, nfev, converged)
+            of each start.
+        """
+        minimize_info = dict(minimize_info or DEFAULT_MINIMIZE)
+        points, start_values, cov = chain_starts(samples, self.names, starts, min_distance)
+        if len(points) < starts:
+            self.log.warning("Only %d distinct starting points in the chains", len(points))
+        # the minimizer works in the coordinates where the chain covariance is the identity,
+        # so that its unit steps are of one standard deviation along uncorrelated directions
+        transform = np.linalg.cholesky(cov)
+        context = spawn_context()
+        progress = (context.RawArray('d', [np.inf] * len(points)), context.RawArray('i', len(points)),
+                    context.RawArray('b', len(points)))
+        tasks = [(i, x0, transform, minimize_info) for i, x0 in enumerate(points)]
+        # starts beyond the number of processes wait for a free one, and are skipped if
+        # the others have agreed by then
+        with self._pool(min(self.processes or len(points), len(points)), progress) as pool:
+            pending = pool.map_async(_minimize, tasks, chunksize=1)
+            stopped = False
+            while not pending.ready():
+                pending.wait(poll)
+                if not stopped and not pending.ready():
+                    stopped = self._stop_if_agreeing(progress, tol)
+            results = pending.get()
+        points, values, nfev, converged = (list(r) for r in zip(*results))
+        best = int(np.argmin(values))
+        self.log.info("Best start %d: -log(posterior) %.6f (%d evaluations)", best, values[best], nfev[best])
+        if not converged[best]:
+            self.log.warning("The best start did not converge")
+        return {'params': dict(zip(self.names, points[best])), 'minuslogpost': values[best], 'nfev': sum(nfev),
+                'converged': converged[best], 'starts': list(zip(start_values, values, nfev, converged))}
+
+
+def write_minimum(filename, model, params):
+    """
+    Write the point (sampled parameters) with its derived parameters, priors and chi2's
+    as a Cobaya .minimum.txt file.
+    """
+    from cobaya.collection import OnePoint
+    x = np.array([params[p] for p in model.parameterization.sampled_params()])
+    logposterior = model.logposterior(x, cached=False)
+    minimum = OnePoint(model)
+    minimum.add(x, derived=logposterior.derived, logpost=logposterior.logpost, logpriors=logposterior.logpriors,
+                loglikes=logposterior.loglikes)
+    np.savetxt(filename, minimum.data.to_numpy(dtype=np.float64), fmt='%.10g',
+               header=' '.join(minimum.data.columns))
+
+
+def main(argv=None):
+    from cobaya.input import load_input
+    from cobaya.yaml import yaml_dump_file
+    from getdist.mcsamples import loadMCSamples
+    parser = argparse.ArgumentParser(description="Multi-start minimization started from existing chains")
+    parser.add_argument('input', help='Cobaya input yaml file')
+    parser.add_argument('--chains', help='root of the chains (default: output prefix of the input)')
+    parser.add_argument('--starts', type=int, default=8, help='number of minimizations (default: %(default)s)')
+    parser.add_argument('--processes', type=int, help='pool processes (default: the number of starts)')
+    parser.add_argument('--tol', type=float, default=0.01,
+                        help='agreement in -log(posterior) at which the other starts stop (default: %(default)s)')
+    parser.add_argument('--min-distance', type=float, default=1.0,
+                        help='minimum distance between starts, in chain standard deviations (default: %(default)s)')
+    parser.add_argument('--ignore-rows', type=float, default=0.3, help='burn-in fraction (default: %(default)s)')
+    parser.add_argument('--output', help='output prefix (default: that of the input)')
+    args = parser.parse_args(argv)
+
+    info = load_input(args.input)
+    output = args.output or info.get('output')
+    chains = args.chains or info.get('output')
+    if not output or not chains:
+        parser.error("no output prefix or chains given, and the input has none")
+    samples = loadMCSamples(chains, settings={'ignore_rows': args.ignore_rows})
+    minimizer = WarmMinimizer(info, processes=args.processes)
+    model = minimizer.model
+    result = minimizer.run(samples, args.starts, minimize_settings(info), args.tol, args.min_distance)
+    for i, (start, value, nfev, converged) in enumerate(result['starts']):
+        print(f"start {i}: -log(posterior) {start:.4f} -> {value:.4f} in {nfev} evaluations"
+              f"{' (converged)' if converged else ''}")
+    write_minimum(output + '.minimum.txt', model, result['params'])
+    yaml_dump_file(output + '.minimize.input.yaml', dict(info, sampler={'minimize': None}), error_if_exists=False)
+    print(f"-log(posterior) = {result['minuslogpost']:.6f} after {result['nfev']} evaluations, "
+          f"written to {output}.minimum.txt")
+    model.close()
+
+
+if __name__ == '__main__':
+    main()
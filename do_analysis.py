@@ -1,16 +1,22 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.font_manager
 import matplotlib.patheffects as path_effects
 from getdist.mcsamples import MCSamplesFromCobaya
-from getdist.mcsamples import loadMCSamples
 import getdist.plots as gdplt
-import yaml
-from yaml.loader import SafeLoader
 from scipy.stats import chi2
 from scipy.special import erf
 from scipy.optimize import fsolve
+from chain_store import ChainStore, chain_files, file_stamp
 # make plots pretty
 plt.rc('font',**{'size':'22','family':'serif','serif':['CMU serif']})
 plt.rc('mathtext', **{'fontset':'cm'})
@@ -34,21 +40,52 @@ matplotlib.rcParams['axes.titlesize'] = 30
 matplotlib.rcParams['text.latex.preamble'] = r'\usepackage{amsmath, amssymb}'
 
 RM1_CUT = 0.02
+# chains, best fits and minimizer inputs, each read once per run
+CHAINS = ChainStore('chains',ignore_rows=0.3)
+
+# chains used by each figure
+FIG0_NAMES = [
+'lcdm_mnu=0.06_tau=free_cmb-p+cmb-l',
+]
+FIG1_NAMES = [
+'lcdm-lite_mnu=0.06_tau=0.06_bao',
+'lcdm_mnu=0.06_tau=0.06_cmb-p+cmb-l',
+'lcdm_mnu=0.06_tau=0.09_cmb-p+cmb-l',
+]
+FIG2_NAMES = [
+'lcdm_mnu=free_tau=0.06_cmb-p+cmb-l+bao', 
+'lcdm_mnu=free_tau=0.09_cmb-p+cmb-l+bao', 
+'lcdm_mnu=free_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
+]
+FIG3_NAMES = [
+'w0wa_mnu=0.06_tau=0.06_cmb-p+cmb-l+bao',
+'w0wa_mnu=0.06_tau=0.09_cmb-p+cmb-l+bao',
+]
+FIG4_NAMES = [
+'lcdm_mnu=0.06_tau=free_cmb-p+cmb-l+bao',
+'lcdm_mnu>0.06_tau=free_cmb-p+cmb-l+bao',
+'lcdm_mnu=0.06_tau=free_cmb-p+cmb-lowl+cmb-l+bao', 
+'lcdm_mnu>0.06_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
+]
+# (dataset, tau, w0wa, lcdm) best fits compared by print_w0wa_preference
+W0WA_PAIRS = [(dataset,tau,f'w0wa_mnu=0.06_tau={tau}_{dataset}',f'lcdm_mnu=0.06_tau={tau}_{dataset}')
+              for dataset in ['cmb-p+cmb-l+bao'] for tau in [0.06,0.09]]
 
 ################################################
 ####          Helper functions               ###
 ################################################
 
-def load_chains(names,rm1_cut=RM1_CUT,verbose=True):
+def load_chains(names,rm1_cut=RM1_CUT,verbose=True,params=None):
+    # params: columns to load from binary chains (all by default), see binary_chains.py
     chains = []
     for name in names:
         try: 
-            chain = loadMCSamples(f'chains/{name}',settings={'ignore_rows':0.3})
+            chain = CHAINS.samples(name,params)
             chains.append(chain)
         except: 
             s = f"Chains have not been run for {name}.yaml"
             raise RuntimeError(s)
-        rm1 = chain.getGelmanRubin()
+        rm1 = CHAINS.gelman_rubin(name)
         if verbose: print(f"R-1={rm1:0.3f} for {name}.yaml",flush=True)
         if rm1>rm1_cut: 
             s = f"R-1={rm1:0.3f}>{rm1_cut} for {name}.yaml"
@@ -56,18 +93,11 @@ def load_chains(names,rm1_cut=RM1_CUT,verbose=True):
     return chains
 
 def get_bestFit_values(fn):
-    fullfn = f'chains/{fn}.minimum.txt'
-    for line in open(fullfn):
-        li=line.strip()
-        if li.startswith("#"):
-            header = li
-    header = np.array(header.split())[1:].tolist()
-    bf = np.loadtxt(fullfn)
-    return dict(zip(header,bf))
+    return CHAINS.best_fit(fn)
 
 def deltaChi2_w0wa_vs_lcdm(w0wa_fn,lcdm_fn):
-    w0wa_info = yaml.load(open(f'chains/{w0wa_fn}.minimize.input.yaml'), Loader=SafeLoader)
-    lcdm_info = yaml.load(open(f'chains/{lcdm_fn}.minimize.input.yaml'), Loader=SafeLoader)
+    w0wa_info = CHAINS.minimize_input(w0wa_fn)
+    lcdm_info = CHAINS.minimize_input(lcdm_fn)
     w0wa_logP = -1*get_bestFit_values(w0wa_fn)['minuslogpost']
     lcdm_logP = -1*get_bestFit_values(lcdm_fn)['minuslogpost']
     w0wa_area = w0wa_info['params']['w']['prior']['max']-w0wa_info['params']['w']['prior']['min']
@@ -80,9 +110,10 @@ def deltaChi2_to_sigma(dchi2,dof=2):
     return fsolve(dcdf, 2)[0]
 
 def lcdm_H0rd_OmM(fn):
-    bf_H0rd = get_bestFit_values(fn)['H0rd']
-    bf_OmM  = get_bestFit_values(fn)['OmegaM']
-    chain   = load_chains([fn],verbose=False)[0]
+    bf      = get_bestFit_values(fn)
+    bf_H0rd = bf['H0rd']
+    bf_OmM  = bf['OmegaM']
+    chain   = load_chains([fn],verbose=False,params=['H0rd','OmegaM'])[0]
     param_names_all = [p.name for p in chain.getParamNames().names]
     selected_params = ['H0rd','OmegaM']
     indices = [param_names_all.index(name) for name in selected_params]
@@ -105,10 +136,7 @@ def make_figure_1a():
     g.settings.axes_fontsize = 20 
     g.settings.axis_marker_color = 'k'
     g.settings.axis_marker_lw = 1.2
-    FIG0_NAMES = [
-    'lcdm_mnu=0.06_tau=free_cmb-p+cmb-l',
-    ]
-    chains = load_chains(FIG0_NAMES)
+    chains = load_chains(FIG0_NAMES,params=['tau','OmegaM'])
     labels = [r'CMB']
     colors = ['green']
     g.rectangle_plot(['tau'],['OmegaM'],plot_roots=[[chains]],
@@ -137,12 +165,7 @@ def make_figure_1b():
     g.settings.axes_fontsize = 20 
     g.settings.axis_marker_color = 'k'
     g.settings.axis_marker_lw = 1.2
-    FIG1_NAMES = [
-    'lcdm-lite_mnu=0.06_tau=0.06_bao',
-    'lcdm_mnu=0.06_tau=0.06_cmb-p+cmb-l',
-    'lcdm_mnu=0.06_tau=0.09_cmb-p+cmb-l',
-    ]
-    chains = load_chains(FIG1_NAMES)
+    chains = load_chains(FIG1_NAMES,params=['H0rd','OmegaM'])
     labels = [r'DESI DR2 BAO',r'CMB, $\tau=0.06$',r'CMB, $\tau=0.09$']
     colors = ['C0','C6','k']
     g.rectangle_plot(['H0rd'],['OmegaM'],plot_roots=[[chains]],
@@ -166,6 +189,8 @@ def make_figure_1b():
     plt.xlim(96.8,103.5)
     plt.ylim(0.276,0.34)
     plt.savefig('figures/H0rd_OmM_contours.pdf', dpi=100, bbox_inches='tight')
+
+def print_lcdm_tension():
     dchi2,nsig = lcdm_tension(FIG1_NAMES[0],FIG1_NAMES[1])
     print(f"DESI vs CMB (tau=0.06): Delta chi^2 = {dchi2:0.02f}, or {nsig:0.03f}sigma")
     dchi2,nsig = lcdm_tension(FIG1_NAMES[0],FIG1_NAMES[2])
@@ -186,12 +211,7 @@ def make_figure_2():
     g.settings.axes_fontsize = 20 
     g.settings.axis_marker_color = 'k'
     g.settings.axis_marker_lw = 1.2
-    FIG2_NAMES = [
-    'lcdm_mnu=free_tau=0.06_cmb-p+cmb-l+bao', 
-    'lcdm_mnu=free_tau=0.09_cmb-p+cmb-l+bao', 
-    'lcdm_mnu=free_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
-    ]
-    chains = load_chains(FIG2_NAMES)
+    chains = load_chains(FIG2_NAMES,params=['mnu_eff'])
     for c in chains:
         for x in c.getParamNames().names:
             if x.name == 'mnu_eff':
@@ -226,11 +246,7 @@ def make_figure_3():
     g.settings.axis_marker_color = 'k'
     g.settings.axis_marker_lw = 1.2
     lcdm_color='gold'
-    FIG3_NAMES = [
-    'w0wa_mnu=0.06_tau=0.06_cmb-p+cmb-l+bao',
-    'w0wa_mnu=0.06_tau=0.09_cmb-p+cmb-l+bao',
-    ]
-    chains = load_chains(FIG3_NAMES)
+    chains = load_chains(FIG3_NAMES,params=['w','wa'])
     labels = [r'$\tau=0.06$',r'$\tau=0.09$']
     colors = ['C6','k']
     g.rectangle_plot(['w'],['wa'],plot_roots=[[chains]],
@@ -259,15 +275,14 @@ def make_figure_3():
     text=plt.text(-0.98,0.2,r'$\boldsymbol{\Lambda}$\textbf{CDM}',ha='left', va='bottom',fontsize=20,color=lcdm_color)
     text.set_path_effects([path_effects.Stroke(linewidth=2, foreground='black'),path_effects.Normal()])
     plt.savefig('figures/w0_wa_contours.pdf', dpi=100, bbox_inches='tight')
-    for dataset in ['cmb-p+cmb-l+bao']:
-        for tau in [0.06,0.09]: 
-            w0wa_fn = f'w0wa_mnu=0.06_tau={tau}_{dataset}'
-            lcdm_fn = f'lcdm_mnu=0.06_tau={tau}_{dataset}'
-            delt = deltaChi2_w0wa_vs_lcdm(w0wa_fn,lcdm_fn)
-            sig = deltaChi2_to_sigma(delt,dof=2)
-            s = f"w0wa preference over lcdm -- {dataset}, tau={tau:0.03f}"
-            s=s+f" -- Delta chi^2 = {delt:0.02f}, or {sig:0.03f}sigma"
-            print(s,flush=True)
+
+def print_w0wa_preference():
+    for dataset,tau,w0wa_fn,lcdm_fn in W0WA_PAIRS:
+        delt = deltaChi2_w0wa_vs_lcdm(w0wa_fn,lcdm_fn)
+        sig = deltaChi2_to_sigma(delt,dof=2)
+        s = f"w0wa preference over lcdm -- {dataset}, tau={tau:0.03f}"
+        s=s+f" -- Delta chi^2 = {delt:0.02f}, or {sig:0.03f}sigma"
+        print(s,flush=True)
 
 ################################################
 ####               Figure 4                  ###
@@ -280,12 +295,7 @@ def make_figure_4():
     g.settings.axes_fontsize = 20 
     g.settings.axis_marker_color = 'k'
     g.settings.axis_marker_lw = 1.2
-    FIG4_NAMES = ['lcdm_mnu=0.06_tau=free_cmb-p+cmb-l+bao',
-                  'lcdm_mnu>0.06_tau=free_cmb-p+cmb-l+bao',
-                  'lcdm_mnu=0.06_tau=free_cmb-p+cmb-lowl+cmb-l+bao', 
-                  'lcdm_mnu>0.06_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
-    ]
-    chains = load_chains(FIG4_NAMES)
+    chains = load_chains(FIG4_NAMES,params=['tau'])
     labels = [r"high-$\ell$ CMB + CMB lensing + BAO",
               None,
               r"+ low-$\ell$ CMB",
@@ -308,8 +318,124 @@ def make_figure_4():
 ####          Make the figures               ###
 ################################################
 
+def minimizer_files(names,yaml=False):
+    files = [f'chains/{n}.minimum.txt' for n in names]
+    return files+[f'chains/{n}.minimize.input.yaml' for n in names] if yaml else files
+
+# name: (function, [(chain names, columns), ...] loaded before the workers start,
+#        other input files, output files)
+TASKS = {
+'figure_1a':      (make_figure_1a,       [(FIG0_NAMES,['tau','OmegaM'])],  [],
+                   ['figures/tau_OmM_contours.pdf']),
+'figure_1b':      (make_figure_1b,       [(FIG1_NAMES,['H0rd','OmegaM'])], [],
+                   ['figures/H0rd_OmM_contours.pdf']),
+'figure_2':       (make_figure_2,        [(FIG2_NAMES,['mnu_eff'])],       [],
+                   ['figures/mnu_eff.pdf']),
+'figure_3':       (make_figure_3,        [(FIG3_NAMES,['w','wa'])],        minimizer_files(FIG3_NAMES),
+                   ['figures/w0_wa_contours.pdf']),
+'figure_4':       (make_figure_4,        [(FIG4_NAMES,['tau'])],           [],
+                   ['figures/tau_infer.pdf']),
+'lcdm_tension':   (print_lcdm_tension,   [(FIG1_NAMES,['H0rd','OmegaM'])], minimizer_files(FIG1_NAMES),
+                   []),
+'w0wa_preference':(print_w0wa_preference,[],
+                   minimizer_files([fn for pair in W0WA_PAIRS for fn in pair[2:]],yaml=True),[]),
+}
+# inputs and printed output of the tasks last run, to skip those whose inputs have not changed
+MANIFEST = 'figures/manifest.json'
+GROUPS = {'figure_1':['figure_1a','figure_1b'],
+          'figures':[t for t in TASKS if t.startswith('figure')],
+          'tensions':['lcdm_tension','w0wa_preference']}
+
+def run_task(name):
+    # output is collected and printed by the main process, so that tasks do not interleave
+    output = io.StringIO()
+    start = time.time()
+    error = None
+    try:
+        with contextlib.redirect_stdout(output):
+            TASKS[name][0]()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    plt.close('all')
+    return name,time.time()-start,output.getvalue(),error
+
+def run_tasks(names,processes=None):
+    """
+    Run the given tasks in parallel worker processes. The chains are loaded first, so
+    that the (forked) workers share them read-only instead of each reading them again.
+    """
+    for name in names:
+        for chain_names,params in TASKS[name][1]:
+            try: load_chains(chain_names,verbose=False,params=params)
+            except RuntimeError: pass # reported by the task itself
+    processes = min(processes or os.cpu_count() or 1,len(names))
+    pool = None
+    if processes==1 or 'fork' not in multiprocessing.get_all_start_methods():
+        results = map(run_task,names)
+    else:
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        results = pool.imap(run_task,names)
+    finished = {}
+    for name,dt,output,error in results:
+        print(f"== {name} ({dt:0.1f}s) ==",flush=True)
+        if output: print(output,end='',flush=True)
+        if error: print(f"FAILED: {error}",flush=True)
+        finished[name] = (output,error)
+    if pool is not None: pool.close()
+    return finished
+
+def task_inputs(name):
+    # the script itself is an input of every task
+    files = [os.path.abspath(__file__)]+TASKS[name][2]
+    for chain_names,_ in TASKS[name][1]:
+        for chain_name in chain_names: files += chain_files(CHAINS.root(chain_name))
+    return json.loads(json.dumps(file_stamp(files)))
+
+def read_manifest():
+    try:
+        with open(MANIFEST) as f: return json.load(f)
+    except (OSError,ValueError): return {}
+
+def write_manifest(manifest):
+    with open(MANIFEST+'.tmp','w') as f: json.dump(manifest,f,indent=1)
+    os.replace(MANIFEST+'.tmp',MANIFEST)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make the figures and tension statistics")
+    parser.add_argument('tasks',nargs='*',metavar='TASK',
+                        help=f"tasks to run (default: all), from {list(TASKS)} or groups {list(GROUPS)}")
+    parser.add_argument('-j','--processes',type=int,help='worker processes (default: number of CPUs)')
+    parser.add_argument('--force',action='store_true',help='run the tasks even if their inputs have not changed')
+    args = parser.parse_args(argv)
+    unknown = [t for t in args.tasks if t not in TASKS and t not in GROUPS]
+    if unknown: parser.error(f"unknown task(s) {unknown}, choose from {list(TASKS)} or {list(GROUPS)}")
+    names = []
+    for task in args.tasks or list(TASKS):
+        names += [t for t in GROUPS.get(task,[task]) if t not in names]
+    # no display is needed in the workers
+    plt.switch_backend('Agg')
+    os.makedirs('figures',exist_ok=True)
+    start = time.time()
+    manifest = read_manifest()
+    inputs = {name:task_inputs(name) for name in names}
+    todo = []
+    for name in names:
+        entry = manifest.get(name)
+        if (args.force or entry is None or entry['inputs']!=inputs[name]
+                or not all(os.path.exists(f) for f in TASKS[name][3])):
+            todo.append(name)
+            continue
+        print(f"== {name} (unchanged) ==",flush=True)
+        if entry['output']: print(entry['output'],end='',flush=True)
+    finished = run_tasks(todo,args.processes) if todo else {}
+    for name,(output,error) in finished.items():
+        if error: manifest.pop(name,None)
+        else: manifest[name] = {'inputs':inputs[name],'output':output}
+    write_manifest(manifest)
+    print(f"Finished {len(todo)} task(s) in {time.time()-start:0.1f}s, {len(names)-len(todo)} unchanged",flush=True)
+    failed = [name for name,(_,error) in finished.items() if error]
+    if failed:
+        sys.exit(f"Failed: {' '.join(failed)}")
+
 if __name__ == "__main__":
-    make_figure_1()
-    make_figure_2()
-    make_figure_3()
-    make_figure_4()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -19,58 +19,13 @@ else
   echo "Creating conda env: cobaya_up2d8"
   bash create_cobaya_env.sh
 fi
-# submits jobs to the queue (if not already submitted)
-cd yamls
-sample_and_minimize=(
-'lcdm_mnu=0.06_tau=0.06_cmb-p+cmb-l'
-'lcdm_mnu=0.06_tau=0.09_cmb-p+cmb-l'
-'w0wa_mnu=0.06_tau=0.06_cmb-p+cmb-l+bao'
-'w0wa_mnu=0.06_tau=0.09_cmb-p+cmb-l+bao'
-'lcdm_mnu=free_tau=0.06_cmb-p+cmb-l+bao'
-'lcdm_mnu=free_tau=0.09_cmb-p+cmb-l+bao'
-'lcdm_mnu=0.06_tau=free_cmb-p+cmb-l+bao'
-)
-sample=(
-'lcdm_mnu=0.06_tau=free_cmb-p'
-'lcdm_mnu=0.06_tau=free_cmb-p+cmb-l'
-'lcdm-lite_mnu=0.06_tau=0.06_bao'
-'lcdm_mnu=free_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
-'lcdm_mnu>0.06_tau=free_cmb-p+cmb-l+bao'
-'lcdm_mnu=0.06_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
-'lcdm_mnu>0.06_tau=free_cmb-p+cmb-lowl+cmb-l+bao'
-"${sample_and_minimize[@]}"
-)
-minimize=(
-'lcdm_mnu=0.06_tau=0.06_cmb-p+cmb-l+bao'
-'lcdm_mnu=0.06_tau=0.09_cmb-p+cmb-l+bao'
-"${sample_and_minimize[@]}"
-)
-if $submit; then
-  for filename in "${sample[@]}"; do
-    if [ ! -f ../chains/$filename.chains_submitted ]; then
-      JOBID=$(sbatch run_chains.sh $filename | awk '{print $4}')
-      for i in $(seq 2 $njobs); do
-        JOBID=$(sbatch --dependency=afterany:$JOBID run_chains.sh $filename | awk '{print $4}')
-      done
-      touch ../chains/$filename.chains_submitted
-      echo "Submitted jobs: run_chains.sh $filename"
-    else
-      echo "Already submitted: run_chains.sh $filename"
-    fi
-  done
-  for filename in "${minimize[@]}"; do
-    if [ ! -f ../chains/$filename.minimizer_submitted ]; then
-      JOBID=$(sbatch minimize.sh $filename | awk '{print $4}')
-      touch ../chains/$filename.minimizer_submitted
-      echo "Submitted job: minimize.sh $filename"
-    else
-      echo "Already submitted: minimize.sh $filename"
-    fi
-  done
-fi
-# make plots
-cd ..
+# orchestrate.py and the plots use the cobaya environment
 module load texlive
 module load python/3.9
 conda activate cobaya_up2d8
+# submits the runs of yamls/runs.yaml to the queue (if not already converged, done or queued)
+if $submit; then
+  python orchestrate.py --backend slurm --njobs $njobs
+fi
+# make plots
 python do_analysis.py
\ No newline at end of file
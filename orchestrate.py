@@ -0,0 +1,378 @@
+"""
+Schedules the sampling and minimization runs listed in yamls/runs.yaml, either on the
+local machine (a pool of processes sharing its cores) or through Slurm (runs smaller
+than a node packed into one job). Chains whose R-1 is already below the target, and
+minimizations with a .minimum.txt, are not run again; nor are runs still queued from a
+previous call (Slurm). The outputs are found from the `output` prefix of each yaml. With
+`warm_start` in runs.yaml, the minimization of a yaml is run after its sampling, and
+started from its chains if they have converged. E.g.
+
+    python orchestrate.py --backend slurm --njobs 3
+    python orchestrate.py --backend local --cores 8 --only sample lcdm-lite_mnu=0.06_tau=0.06_bao
+    python orchestrate.py --backend slurm --dry-run
+
+Submitted Slurm jobs are recorded in log/orchestrator.json, and the output of each run
+goes to log/<name>.<sample|minimize>.log.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import warnings
+
+import yaml
+
+import convergence_monitor
+
+SAMPLE, MINIMIZE = 'sample', 'minimize'
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Task:
+    """
+    A sampling or minimization run of one input yaml, with its output root (as set in
+    the yaml), MPI ranks and OpenMP threads per rank.
+    """
+
+    def __init__(self, name, kind, root, ranks, threads):
+        self.name = name
+        self.kind = kind
+        self.root = root
+        self.ranks = int(ranks)
+        self.threads = int(threads)
+
+    @property
+    def cores(self):
+        return self.ranks * self.threads
+
+    @property
+    def label(self):
+        return f'{self.name}.{self.kind}'
+
+    def resized(self, cores):
+        """
+        Get the same task using at most the given number of cores.
+        """
+        if self.cores <= cores:
+            return self
+        ranks = min(self.ranks, cores)
+        return Task(self.name, self.kind, self.root, ranks, max(1, cores // ranks))
+
+    def command(self, launcher, Rminus1, warm_start=False):
+        """
+        Get the bash commands of the run, to be run from the yamls directory. Chains
+        are resumed if they exist, and not run at all if they have already converged;
+        with `warm_start`, minimizations start from the chains if they have converged
+        (see disputauble.warm_minimize), and from the reference point otherwise.
+        """
+        launch = launcher.format(ranks=self.ranks, threads=self.threads)
+        root = shlex.quote(self.root)
+        converged = (f"python {shlex.quote(os.path.join(HERE, 'convergence_monitor.py'))} --check "
+                     f"--rminus1 {Rminus1} --chains-dir {shlex.quote(os.path.dirname(self.root))} "
+                     f"{shlex.quote(os.path.basename(self.root))} > /dev/null")
+        lines = [f'name={shlex.quote(self.name)}', f'export OMP_NUM_THREADS={self.threads}',
+                 'export COBAYA_USE_FILE_LOCKING=false']
+        if self.kind == MINIMIZE:
+            cold = f'{launch} cobaya-run --minimize --force "$name.yaml"'
+            if not warm_start:
+                return '\n'.join(lines + [cold])
+            # unconverged chains may not have reached the best-fit region: their best samples
+            # would be worse starts than the reference point. One start per rank, sharing the cores
+            lines += [f'if {converged}; then',
+                      '    echo "Minimizing from the chains of: $name"',
+                      f'    OMP_NUM_THREADS={self.cores} {launcher.format(ranks=1, threads=self.cores)} '
+                      f'python -m disputauble.warm_minimize "$name.yaml" --starts {self.ranks}',
+                      'else',
+                      '    echo "Chains have not converged, minimizing from the reference point: $name"',
+                      f'    {cold}',
+                      'fi']
+            return '\n'.join(lines)
+        lines += [f'if {converged}; then',
+                  '    echo "Chains have converged: $name"',
+                  f'elif test -f {root}.1.txt; then',
+                  f'    rm -f {root}.*lock*',
+                  '    echo "Resuming chains with name: $name"',
+                  f'    {launch} cobaya-run {root}',
+                  'else',
+                  '    echo "Starting a new chain with name: $name"',
+                  f'    {launch} cobaya-run "$name.yaml"',
+                  'fi']
+        return '\n'.join(lines)
+
+
+def output_root(yamls_dir, name):
+    """
+    Get the output prefix of an input yaml, as an absolute path.
+    """
+    from cobaya.yaml import yaml_load_file
+    output = yaml_load_file(os.path.join(yamls_dir, name + '.yaml')).get('output')
+    if not output:
+        raise ValueError(f"{name}.yaml has no output prefix")
+    return os.path.normpath(os.path.join(os.path.abspath(yamls_dir), output))
+
+
+def load_plan(yamls_dir):
+    """
+    Read the runs.yaml of the yamls directory.
+
+    Returns
+    -------
+    tuple
+        The plan (dict) and the list of tasks.
+    """
+    with open(os.path.join(yamls_dir, 'runs.yaml'), encoding='utf-8') as f:
+        plan = yaml.safe_load(f)
+    tasks = []
+    for name, kinds in plan['runs'].items():
+        if not os.path.exists(os.path.join(yamls_dir, name + '.yaml')):
+            warnings.warn(f"Skipping {name}: {name}.yaml does not exist in {yamls_dir}")
+            continue
+        if isinstance(kinds, list):
+            kinds = {kind: {} for kind in kinds}
+        root = output_root(yamls_dir, name)
+        for kind, layout in kinds.items():
+            if kind not in (SAMPLE, MINIMIZE):
+                raise ValueError(f"Unknown run type {kind!r} for {name}, use {SAMPLE} or {MINIMIZE}")
+            tasks.append(Task(name, kind, root, **{**plan['defaults'][kind], **(layout or {})}))
+    for filename in sorted(glob.glob(os.path.join(glob.escape(yamls_dir), '*.yaml'))):
+        name = os.path.basename(filename)[:-len('.yaml')]
+        if name != 'runs' and name not in plan['runs']:
+            warnings.warn(f"{name}.yaml is not in runs.yaml, so it is not run")
+    return plan, tasks
+
+
+def is_done(task, Rminus1):
+    """
+    Whether the chains of a sampling task have converged, or a minimization has a result.
+    """
+    if task.kind == MINIMIZE:
+        return os.path.exists(task.root + '.minimum.txt')
+    name = os.path.basename(task.root)
+    return convergence_monitor.check([name], os.path.dirname(task.root), Rminus1)[name]['converged']
+
+
+def sample_label(task):
+    """
+    Label of the sampling task that a minimization task starts from (with warm_start).
+    """
+    return f'{task.name}.{SAMPLE}'
+
+
+def pack(tasks, node_cores):
+    """
+    Group the tasks into nodes, first fit by decreasing size.
+    """
+    nodes = []
+    for task in sorted(tasks, key=lambda t: -t.cores):
+        for node in nodes:
+            if sum(t.cores for t in node) + task.cores <= node_cores:
+                node.append(task)
+                break
+        else:
+            nodes.append([task])
+    return nodes
+
+
+class LocalBackend:
+    """
+    Runs the tasks on this machine, as many at a time as fit in its cores.
+    """
+
+    def __init__(self, cores=None, launcher=None):
+        self.cores = cores or os.cpu_count() or 1
+        if launcher is None:
+            launcher = 'mpirun -n {ranks}' if shutil.which('mpirun') else ''
+        self.launcher = launcher
+
+    def active(self, record):
+        # runs do not outlive the call that started them
+        return False
+
+    def run(self, tasks, plan, yamls_dir, log_dir, dry_run=False, queued=None):
+        warm_start = bool(plan.get('warm_start'))
+        pending = [task.resized(self.cores) for task in tasks]
+        if not self.launcher:
+            pending = [Task(t.name, t.kind, t.root, 1, t.cores) for t in pending]
+
+        def waiting(task, unfinished):
+            # with warm starts, a minimization waits for the sampling of the same yaml
+            return warm_start and task.kind == MINIMIZE and sample_label(task) in {t.label for t in unfinished}
+
+        if dry_run:
+            for task in pending:
+                after = f" (after {sample_label(task)})" if waiting(task, pending) else ''
+                print(f"# {task.label}: {task.ranks} x {task.threads}{after}\n"
+                      f"{task.command(self.launcher, plan['Rminus1'], warm_start)}\n")
+            return {}
+        running = {}
+        record = {}
+        while pending or running:
+            free = self.cores - sum(task.cores for task in running)
+            for task in list(pending):
+                if task.cores > free or waiting(task, pending + list(running)):
+                    continue
+                log = open(os.path.join(log_dir, task.label + '.log'), 'w')
+                running[task] = (subprocess.Popen(['bash', '-c', task.command(self.launcher, plan['Rminus1'],
+                                                                               warm_start)],
+                                                  cwd=yamls_dir, stdout=log, stderr=subprocess.STDOUT), log)
+                pending.remove(task)
+                free -= task.cores
+                print(f"Started {task.label} ({task.ranks} x {task.threads})", flush=True)
+            time.sleep(1)
+            for task, (process, log) in list(running.items()):
+                if process.poll() is not None:
+                    log.close()
+                    del running[task]
+                    record[task.label] = {'backend': 'local', 'returncode': process.returncode}
+                    print(f"Finished {task.label} with status {process.returncode}", flush=True)
+        return record
+
+
+class SlurmBackend:
+    """
+    Submits one single-node job per group of packed tasks. Sampling tasks are packed
+    together and followed by `njobs` - 1 dependent jobs continuing them; minimization
+    tasks are packed into separate jobs that are not repeated and, with warm starts,
+    depend on the sampling jobs of the same yamls.
+    """
+
+    launcher = 'srun --exact -N 1 -n {ranks} -c {threads}'
+
+    def __init__(self, njobs=3):
+        self.njobs = njobs
+
+    def active(self, record):
+        job_ids = (record or {}).get('job_ids')
+        if not job_ids or record.get('backend') != 'slurm':
+            return False
+        queued = subprocess.run(['squeue', '-h', '-o', '%i', '-j', ','.join(job_ids)], capture_output=True,
+                                text=True).stdout.split()
+        return bool(queued)
+
+    def job_script(self, tasks, plan, yamls_dir, log_dir, job_name):
+        slurm = plan.get('slurm') or {}
+        lines = ['#!/bin/bash -l', f'#SBATCH -J {job_name}', f"#SBATCH -t {slurm.get('time', '2:00:00')}",
+                 '#SBATCH -N 1', f'#SBATCH -o {os.path.abspath(log_dir)}/{job_name}.%j.out']
+        lines += [f'#SBATCH {option} {slurm[key]}' for key, option in
+                  (('qos', '-q'), ('constraint', '-C'), ('account', '-A')) if slurm.get(key)]
+        lines += [slurm.get('setup', ''), f'cd {shlex.quote(os.path.abspath(yamls_dir))}']
+        for task in tasks:
+            log = shlex.quote(os.path.join(os.path.abspath(log_dir), task.label + '.log'))
+            command = task.command(self.launcher, plan['Rminus1'], bool(plan.get('warm_start')))
+            lines.append(f"(\n{command}\n) >> {log} 2>&1 &")
+        lines.append('wait')
+        return '\n'.join(lines) + '\n'
+
+    def run(self, tasks, plan, yamls_dir, log_dir, dry_run=False, queued=None):
+        """
+        Submit the tasks. `queued` has the records of the tasks already in the queue,
+        which the new ones may depend on. With `dry_run`, the sbatch commands are
+        printed with the job ids replaced by job1, job2, ...
+        """
+        record = {}
+        queued = queued or {}
+        jobs_dir = os.path.join(log_dir, 'jobs')
+        nodes = [(node, self.njobs) for node in pack([t for t in tasks if t.kind == SAMPLE], plan['node_cores'])]
+        nodes += [(node, 1) for node in pack([t for t in tasks if t.kind == MINIMIZE], plan['node_cores'])]
+        submitted = 0
+        for i, (node, njobs) in enumerate(nodes):
+            job_name = node[0].kind if len(node) == 1 else f'packed-{node[0].kind}'
+            script = self.job_script(node, plan, yamls_dir, log_dir, job_name)
+            filename = os.path.join(jobs_dir, f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{i}.sh")
+            labels = ', '.join(f'{t.label} ({t.ranks} x {t.threads})' for t in node)
+            after = []
+            if plan.get('warm_start'):
+                for task in node:
+                    sampling = record.get(sample_label(task)) or queued.get(sample_label(task)) or {}
+                    after += [job_id for job_id in sampling.get('job_ids', [])[-1:] if job_id not in after]
+            if dry_run:
+                print(f"# node {i}: {labels}\n{script}")
+            else:
+                os.makedirs(jobs_dir, exist_ok=True)
+                with open(filename, 'w', encoding='utf-8') as f:
+                    f.write(script)
+            job_ids = []
+            for _ in range(njobs):
+                dependency = job_ids[-1:] or after
+                command = ['sbatch', '--parsable'] + ([f"--dependency=afterany:{':'.join(dependency)}"]
+                                                      if dependency else []) + [filename]
+                if dry_run:
+                    submitted += 1
+                    job_ids.append(f'job{submitted}')
+                    print(f"{job_ids[-1]}: {' '.join(command)}")
+                    continue
+                job_ids.append(subprocess.run(command, check=True, capture_output=True,
+                                              text=True).stdout.strip().split(';')[0])
+            print(f"Submitted jobs {', '.join(job_ids)}: {labels}", flush=True)
+            for task in node:
+                record[task.label] = {'backend': 'slurm', 'job_ids': job_ids, 'script': filename,
+                                      'submitted': datetime.datetime.now().isoformat(timespec='seconds')}
+        return {} if dry_run else record
+
+
+def read_state(filename):
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Schedule the sampling and minimization runs of yamls/runs.yaml")
+    parser.add_argument('names', nargs='*', help='runs to consider (default: all in runs.yaml)')
+    parser.add_argument('--backend', choices=['local', 'slurm'], default='local')
+    parser.add_argument('--only', choices=[SAMPLE, MINIMIZE], help='only this type of run')
+    parser.add_argument('--yamls', default=os.path.join(HERE, 'yamls'), help='directory of the input yamls')
+    parser.add_argument('--log', default=os.path.join(HERE, 'log'), help='directory of the logs')
+    parser.add_argument('--njobs', type=int, default=3, help='chained Slurm jobs per sampling submission')
+    parser.add_argument('--cores', type=int, help='cores used by the local backend (default: all)')
+    parser.add_argument('--launcher', help="MPI launcher of the local backend (default: 'mpirun -n {ranks}')")
+    parser.add_argument('--dry-run', action='store_true', help='print the commands or job scripts only')
+    args = parser.parse_args(argv)
+
+    plan, tasks = load_plan(args.yamls)
+    unknown = set(args.names) - {task.name for task in tasks}
+    if unknown:
+        parser.error(f"not in runs.yaml: {sorted(unknown)}")
+    tasks = [t for t in tasks if (not args.names or t.name in args.names) and (not args.only or t.kind == args.only)]
+    os.makedirs(args.log, exist_ok=True)
+    state_file = os.path.join(args.log, 'orchestrator.json')
+    state = read_state(state_file)
+    if args.backend == 'slurm':
+        backend = SlurmBackend(args.njobs)
+    else:
+        backend = LocalBackend(args.cores, args.launcher)
+
+    todo = []
+    queued = {}
+    for task in tasks:
+        if is_done(task, plan['Rminus1']):
+            print(f"Done: {task.label}")
+        elif backend.active(state.get(task.label)):
+            print(f"Queued or running: {task.label}")
+            queued[task.label] = state[task.label]
+        else:
+            todo.append(task)
+    if not todo:
+        return
+    record = backend.run(todo, plan, args.yamls, args.log, dry_run=args.dry_run, queued=queued)
+    if args.dry_run:
+        return
+    state.update(record)
+    with open(state_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=1)
+    failed = [label for label, r in record.items() if r.get('returncode')]
+    if failed:
+        sys.exit(f"Failed: {' '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+The key of the persistent cache must be the same in every process, whatever the hash
+seed, so that runs, chains and the minimizer share the cached products.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('camb')
+pytest.importorskip('cobaya')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = textwrap.dedent("""
+    import sys
+    from cobaya.model import get_model
+
+    info = {
+        'theory': {'disputauble.CobayaCAMB_mnuEff': {'disk_cache': sys.argv[1],
+                                                     'extra_args': {'lmax': 600, 'lens_potential_accuracy': 1}}},
+        'likelihood': {'cls': {'external': lambda _self=None: 0.0,
+                               'requires': {'Cl': {'tt': 500, 'te': 500, 'ee': 500, 'bb': 500, 'pp': 500}}}},
+        'params': {'ombh2': 0.0224, 'omch2': 0.12, 'H0': 67.5, 'tau': 0.06, 'logA': 3.05, 'ns': 0.965,
+                   'As': {'value': 'lambda logA: 1e-10*np.exp(logA)'}, 'mnu_eff': -0.05},
+    }
+    model = get_model(info)
+    model.logposterior({})
+    theory = model.theory['disputauble.CobayaCAMB_mnuEff']
+    print(theory.disk_cache_key(theory.current_state['params']))
+""")
+
+
+def cache_key(hash_seed, directory):
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed), PYTHONPATH=ROOT, OMP_NUM_THREADS='1')
+    output = subprocess.run([sys.executable, '-c', SCRIPT, str(directory)], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return output.split()[-1]
+
+
+def test_key_independent_of_hash_seed(tmp_path):
+    keys = {seed: cache_key(seed, tmp_path) for seed in (1, 2, 3)}
+    assert len(set(keys.values())) == 1, json.dumps(keys)
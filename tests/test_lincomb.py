@@ -0,0 +1,33 @@
+"""
+Combinations of power spectrum interpolators must be linear in P: log-space values
+cannot be combined.
+"""
+
+import numpy as np
+import pytest
+
+from disputauble.lincomb import LinearCombiner
+
+boltzmannbase = pytest.importorskip('cobaya.theories.cosmo.boltzmannbase')
+
+
+def interpolator(pk, logP):
+    z = np.array([0.0, 0.5, 1.0, 2.0])
+    k = np.logspace(-3, 0, 20)
+    P = pk * np.outer(1 + z, k ** -0.5)
+    return boltzmannbase.PowerSpectrumInterpolator(z, k, np.log(P) if logP else P, logP=logP)
+
+
+@pytest.mark.parametrize('logP', [False, True])
+def test_power_spectrum_interpolators(logP):
+    massless, massive = interpolator(2.0, logP), interpolator(1.5, logP)
+    combination = LinearCombiner().combine((2, -1), (massless, massive))
+    z, k = 0.7, np.array([0.01, 0.1])
+    assert combination.P(z, k) == pytest.approx(2 * massless.P(z, k) - massive.P(z, k))
+    assert combination.kmax == massless.kmax
+    np.testing.assert_array_equal(combination.z, massless.z)
+    with pytest.raises(AttributeError):
+        combination.logP(z, k)
+    if logP:
+        with pytest.raises(TypeError):
+            combination(z, np.log(k), warn=False)
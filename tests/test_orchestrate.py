@@ -0,0 +1,69 @@
+"""
+Dry runs of orchestrate.py on a small plan: sampling jobs are packed and chained,
+minimizations get jobs of their own, started after the sampling of the same yaml.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('cobaya')
+pytest.importorskip('getdist')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLAN = textwrap.dedent("""
+    node_cores: 8
+    Rminus1: 0.01
+    warm_start: true
+    defaults:
+      sample: {ranks: 2, threads: 2}
+      minimize: {ranks: 4, threads: 2}
+    runs:
+      a: [sample, minimize]
+      b: [sample]
+      c: [minimize]
+""")
+
+
+@pytest.fixture
+def yamls_dir(tmp_path):
+    directory = tmp_path / 'yamls'
+    directory.mkdir()
+    (directory / 'runs.yaml').write_text(PLAN)
+    for name in 'abc':
+        (directory / f'{name}.yaml').write_text(f'output: ../chains/{name}\n')
+    return directory
+
+
+def dry_run(yamls_dir, *args):
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'orchestrate.py'), '--dry-run', '--yamls',
+                           str(yamls_dir), '--log', str(yamls_dir.parent / 'log'), *args],
+                          check=True, capture_output=True, text=True).stdout
+
+
+def test_slurm(yamls_dir):
+    output = dry_run(yamls_dir, '--backend', 'slurm', '--njobs', '3')
+    nodes = re.findall(r'^# node \d+: (.*)$', output, re.M)
+    assert nodes == ['a.sample (2 x 2), b.sample (2 x 2)', 'a.minimize (4 x 2)', 'c.minimize (4 x 2)']
+    jobs = re.findall(r'^(job\d+): sbatch --parsable (?:--dependency=afterany:(\S+) )?(\S+)$', output, re.M)
+    assert [(job, after) for job, after, _ in jobs] == [('job1', ''), ('job2', 'job1'), ('job3', 'job2'),
+                                                        ('job4', 'job3'), ('job5', '')]
+    # the samplings are chained, the minimizations are submitted once each
+    assert len({script for _, _, script in jobs}) == 3
+    # the outputs are those of the yamls
+    assert f"cobaya-run {yamls_dir.parent / 'chains' / 'a'}\n" in output
+
+
+def test_local(yamls_dir):
+    output = dry_run(yamls_dir, '--backend', 'local', '--cores', '8')
+    tasks = re.findall(r'^# (\S+): \d+ x \d+(.*)$', output, re.M)
+    assert tasks == [('a.sample', ''), ('a.minimize', ' (after a.sample)'), ('b.sample', ''), ('c.minimize', '')]
+    # warm starts only from converged chains
+    minimize = output.split('# a.minimize')[1].split('# b.sample')[0]
+    assert re.search(r'if python \S+convergence_monitor.py --check --rminus1 0.01 --chains-dir \S+ a > /dev/null; then\n'
+                     r'.*\n.*disputauble.warm_minimize.*\nelse\n.*\n.*cobaya-run --minimize', minimize)
@@ -0,0 +1,55 @@
+"""
+The parallel worker must work when it is started after the main process has run CAMB
+with several OpenMP threads, as in a chain crossing mnu_eff = 0, and give the same
+products as the serial calculation. Lensing is linear: with non-linear lensing, CAMB's
+spectra from time sources change at the 1e-6 level with the previous transfer solve of
+the process, which differs between the two.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('camb')
+pytest.importorskip('cobaya')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = textwrap.dedent("""
+    import json
+    from cobaya.model import get_model
+
+    def info(parallel):
+        return {
+            'theory': {'disputauble.CobayaCAMB_mnuEff': {'parallel_transfers': parallel,
+                                                         'extra_args': {'lmax': 600, 'lens_potential_accuracy': 0}}},
+            'likelihood': {'cls': {'external': lambda _self=None: 0.0,
+                                   'requires': {'Cl': {'tt': 500, 'ee': 500}}}},
+            'params': {'ombh2': 0.0224, 'omch2': 0.12, 'H0': 67.5, 'tau': 0.06, 'logA': 3.05, 'ns': 0.965,
+                       'As': {'value': 'lambda logA: 1e-10*np.exp(logA)'},
+                       'mnu_eff': {'prior': {'min': -1, 'max': 1}}, 'rdrag': {'derived': True}},
+        }
+
+    outputs = {}
+    for parallel in (True, False):
+        model = get_model(info(parallel))
+        theory = model.theory['disputauble.CobayaCAMB_mnuEff']
+        for mnu_eff in (0.1, -0.1):
+            derived = model.logposterior({'mnu_eff': mnu_eff}).derived
+        outputs[parallel] = {'rdrag': derived[-1], 'tt': theory.get_Cl()['tt'][2:].tolist()}
+        model.close()
+    print(json.dumps(outputs))
+""")
+
+
+def test_negative_step_after_positive():
+    env = dict(os.environ, PYTHONPATH=ROOT, OMP_NUM_THREADS='2')
+    output = subprocess.run([sys.executable, '-c', SCRIPT], env=env, check=True, capture_output=True, text=True,
+                            timeout=600).stdout
+    outputs = json.loads(output.splitlines()[-1])
+    assert outputs['true']['rdrag'] == pytest.approx(outputs['false']['rdrag'], rel=1e-10)
+    assert outputs['true']['tt'] == pytest.approx(outputs['false']['tt'], rel=1e-10)
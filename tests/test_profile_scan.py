@@ -0,0 +1,44 @@
+"""
+Evaluation of a profile-likelihood grid in a pool using CAMB with several OpenMP threads,
+from a process that has already run CAMB: it must give the log-posterior of the model at
+each grid value, not hang.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('camb')
+pytest.importorskip('cobaya')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = textwrap.dedent("""
+    import json
+    from disputauble.profile_scan import ProfileScanner
+
+    info = {'theory': {'disputauble.CobayaCAMB_mnuEff': {'extra_args': {'lmax': 600, 'lens_potential_accuracy': 0}}},
+            'likelihood': {'cls': {'external': "lambda _self: float(np.log(_self.provider.get_Cl()['tt'][300]))",
+                                   'requires': {'Cl': {'tt': 500}}}},
+            'params': {'ombh2': 0.0224, 'H0': 67.5, 'tau': 0.06, 'logA': 3.05, 'ns': 0.965,
+                       'As': {'value': 'lambda logA: 1e-10*np.exp(logA)'},
+                       'omch2': {'prior': {'min': 0.1, 'max': 0.14}},
+                       'mnu_eff': {'prior': {'min': -1, 'max': 1}}}}
+    grid = [-0.2, -0.1, 0.1]
+    scanner = ProfileScanner(info, processes=1, threads=2)
+    # the model of this process runs CAMB before the pool is started
+    expected = [float(scanner.model.logposterior({'omch2': 0.12, 'mnu_eff': m}).logpost) for m in grid]
+    print(json.dumps({'expected': expected, 'logpost': scanner.evaluate({'omch2': 0.12}, grid).tolist()}))
+""")
+
+
+def test_evaluate_camb():
+    env = dict(os.environ, PYTHONPATH=ROOT, OMP_NUM_THREADS='2')
+    output = subprocess.run([sys.executable, '-c', SCRIPT], env=env, check=True, capture_output=True, text=True,
+                            timeout=600).stdout
+    result = json.loads(output.splitlines()[-1])
+    assert result['logpost'] == pytest.approx(result['expected'], rel=1e-8)
@@ -0,0 +1,64 @@
+"""
+Warm-started minimization of a model using CAMB with several OpenMP threads, from a
+process that has already run CAMB (as when the model is built and checked before the
+pool is started): it must find the best fit, not hang.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('camb')
+pytest.importorskip('cobaya')
+pytest.importorskip('getdist')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = textwrap.dedent("""
+    import json
+    import numpy as np
+    from cobaya.model import get_model
+    from getdist import MCSamples
+    from disputauble.warm_minimize import WarmMinimizer
+
+    theory = {'disputauble.CobayaCAMB_mnuEff': {'extra_args': {'lmax': 600, 'lens_potential_accuracy': 0}}}
+    params = {'ombh2': 0.0224, 'omch2': 0.12, 'H0': 67.5, 'tau': 0.06, 'mnu_eff': -0.1,
+              'logA': {'prior': {'min': 2.9, 'max': 3.2}}, 'ns': {'prior': {'min': 0.9, 'max': 1.0}},
+              'As': {'value': 'lambda logA: 1e-10*np.exp(logA)'}}
+    truth = {'logA': 3.05, 'ns': 0.965}
+    ells = [30, 300]
+
+    # spectra at the best fit, computed in this process before the pool is started
+    model = get_model({'theory': theory, 'params': params,
+                       'likelihood': {'cls': {'external': lambda _self: 0.0, 'requires': {'Cl': {'tt': 500}}}}})
+    model.logposterior(truth)
+    cl = model.provider.get_Cl(ell_factor=True)['tt'][ells].tolist()
+    info = {'theory': theory, 'params': params,
+            'likelihood': {'cls': {'external': f"lambda _self: -0.5 * np.sum((_self.provider.get_Cl("
+                                               f"ell_factor=True)['tt'][{ells}] / np.array({cl}) - 1) ** 2) / 1e-6",
+                                   'requires': {'Cl': {'tt': 500}}}}}
+
+    sigma = np.array([0.01, 0.004])
+    rng = np.random.default_rng(1)
+    samples = np.array([truth['logA'], truth['ns']]) + rng.normal(size=(500, 2)) * sigma
+    chains = MCSamples(samples=samples, names=['logA', 'ns'], loglikes=0.5 * np.sum((samples - samples.mean(0)) ** 2
+                                                                                     / sigma ** 2, axis=1))
+    minimizer = WarmMinimizer(info, processes=2, threads=4)
+    result = minimizer.run(chains, starts=2, minimize_info={'method': 'Powell', 'tol': 1e-8,
+                                                            'options': {'maxfev': 400}})
+    print(json.dumps({'params': result['params'], 'minuslogpost': result['minuslogpost']}))
+""")
+
+
+def test_warm_minimize_camb():
+    env = dict(os.environ, PYTHONPATH=ROOT, OMP_NUM_THREADS='4')
+    output = subprocess.run([sys.executable, '-c', SCRIPT], env=env, check=True, capture_output=True, text=True,
+                            timeout=900).stdout
+    result = json.loads(output.splitlines()[-1])
+    assert result['minuslogpost'] < 0.1
+    assert result['params']['logA'] == pytest.approx(3.05, abs=0.005)
+    assert result['params']['ns'] == pytest.approx(0.965, abs=0.002)
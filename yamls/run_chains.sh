@@ -13,6 +13,12 @@ conda activate cobaya_up2d8
 rm ../chains/*lock*
 export COBAYA_USE_FILE_LOCKING=false
 export OMP_NUM_THREADS=8
+# jobs queued after the chains have converged (R-1 below the sampler's Rminus1_stop) end straight away
+if python ../convergence_monitor.py --check --rminus1 0.01 --chains-dir ../chains ${name}
+then
+    echo "Chains have converged: ${name}"
+    exit 0
+fi
 if test -f "chains/${name}.1.txt"
 then
     echo "Resuming chains with name: ${name}"